@@ -11,8 +11,18 @@ class Alias:
     def __init__(self, bot):
         self.bot = bot
         self.file_path = "data/alias/aliases.json"
-        self.aliases = dataIO.load_json(self.file_path)
+        self.store = dataIO.open_journaled(self.file_path)
+        self.aliases = self.store.data
         self.remove_old()
+        for sid, aliases in self.aliases.items():
+            for alias in aliases:
+                self.bot.add_command_route(sid, alias, self.run_alias)
+
+    def __unload(self):
+        for sid, aliases in self.aliases.items():
+            for alias in aliases:
+                self.bot.remove_command_route(sid, alias, self.run_alias)
+        self.store.close()
 
     @commands.group(pass_context=True, no_pm=True)
     async def alias(self, ctx):
@@ -40,11 +50,11 @@ class Alias:
         prefix = self.get_prefix(server, to_execute)
         if prefix is not None:
             to_execute = to_execute[len(prefix):]
-        if server.id not in self.aliases:
-            self.aliases[server.id] = {}
-        if command not in self.bot.commands:
-            self.aliases[server.id][command] = to_execute
-            dataIO.save_json(self.file_path, self.aliases)
+        if not self.bot.has_command(command):
+            if command not in self.aliases.get(server.id, {}):
+                self.bot.add_command_route(server.id, command,
+                                           self.run_alias)
+            self.store.set((server.id, command), to_execute)
             await self.bot.say("Alias '{}' added.".format(command))
         else:
             await self.bot.say("Cannot add '{}' because it's a real bot "
@@ -85,9 +95,10 @@ class Alias:
         """Deletes an alias"""
         command = command.lower()
         server = ctx.message.server
-        if server.id in self.aliases:
-            self.aliases[server.id].pop(command, None)
-            dataIO.save_json(self.file_path, self.aliases)
+        if command in self.aliases.get(server.id, {}):
+            self.store.delete((server.id, command))
+            self.bot.remove_command_route(server.id, command,
+                                          self.run_alias)
         await self.bot.say("Alias '{}' deleted.".format(command))
 
     @alias.command(name="list", pass_context=True, no_pm=True)
@@ -109,32 +120,22 @@ class Alias:
             else:
                 await self.bot.say("There are no aliases on this server.")
 
-    async def on_message(self, message):
-        if len(message.content) < 2 or message.channel.is_private:
-            return
-
-        msg = message.content
+    async def run_alias(self, message, parsed):
+        """Routed by the bot to the messages invoking one of the aliases"""
         server = message.server
-        prefix = self.get_prefix(server, msg)
-
-        if not prefix:
-            return
-
-        if server.id in self.aliases and self.bot.user_allowed(message):
-            alias = self.first_word(msg[len(prefix):]).lower()
-            if alias in self.aliases[server.id]:
-                new_command = self.aliases[server.id][alias]
-                args = message.content[len(prefix + alias):]
-                new_message = copy(message)
-                new_message.content = prefix + new_command + args
-                await self.bot.process_commands(new_message)
+        prefix = parsed.prefix
+        alias = parsed.invoked
+        if alias in self.aliases.get(server.id, {}):
+            new_command = self.aliases[server.id][alias]
+            args = message.content[len(prefix + alias):]
+            new_message = copy(message)
+            new_message.content = prefix + new_command + args
+            await self.bot.process_commands(new_message)
 
     def part_of_existing_command(self, alias, server):
         '''Command or alias'''
-        for command in self.bot.commands:
-            if alias.lower() == command.lower():
-                return True
-        return False
+        return (self.bot.get_command(alias, ignore_case=True) is not None
+                or self.bot.has_command(alias))
 
     def remove_old(self):
         for sid in self.aliases:
@@ -151,22 +152,17 @@ class Alias:
                 server = discord.Object(id=sid)
                 prefix = self.get_prefix(server, alias)
                 if prefix is not None:
-                    self.aliases[sid][aliasname] = alias[len(prefix):]
+                    self.store.set((sid, aliasname), alias[len(prefix):])
             for alias in to_delete:  # Fixes caps and bad prefixes
-                del self.aliases[sid][alias]
+                self.store.delete((sid, alias))
             for alias, command in to_add:  # For fixing caps
-                self.aliases[sid][alias] = command
-        dataIO.save_json(self.file_path, self.aliases)
+                self.store.set((sid, alias), command)
 
     def first_word(self, msg):
         return msg.split(" ")[0]
 
     def get_prefix(self, server, msg):
-        prefixes = self.bot.settings.get_prefixes(server)
-        for p in prefixes:
-            if msg.startswith(p):
-                return p
-        return None
+        return self.bot.settings.match_prefix(server, msg)
 
 
 def check_folder():
@@ -179,12 +175,14 @@ def check_file():
     aliases = {}
 
     f = "data/alias/aliases.json"
+    dataIO.set_codec(f, "fast")
     if not dataIO.is_valid_json(f):
         print("Creating default alias's aliases.json...")
         dataIO.save_json(f, aliases)
 
 
 def setup(bot):
-    check_folder()
-    check_file()
+    with bot.startup_profiler.phase(__name__ + " file checks"):
+        check_folder()
+        check_file()
     bot.add_cog(Alias(bot))
@@ -14,7 +14,17 @@ class CustomCommands:
     def __init__(self, bot):
         self.bot = bot
         self.file_path = "data/customcom/commands.json"
-        self.c_commands = dataIO.load_json(self.file_path)
+        self.store = dataIO.open_journaled(self.file_path)
+        self.c_commands = self.store.data
+        for sid, cmdlist in self.c_commands.items():
+            for command in cmdlist:
+                self.bot.add_command_route(sid, command, self.run_cc)
+
+    def __unload(self):
+        for sid, cmdlist in self.c_commands.items():
+            for command in cmdlist:
+                self.bot.remove_command_route(sid, command, self.run_cc)
+        self.store.close()
 
     @commands.group(aliases=["cc"], pass_context=True, no_pm=True)
     async def customcom(self, ctx):
@@ -35,16 +45,13 @@ class CustomCommands:
         """
         server = ctx.message.server
         command = command.lower()
-        if command in self.bot.commands:
+        if self.bot.has_command(command):
             await self.bot.say("That command is already a standard command.")
             return
-        if server.id not in self.c_commands:
-            self.c_commands[server.id] = {}
-        cmdlist = self.c_commands[server.id]
+        cmdlist = self.c_commands.get(server.id, {})
         if command not in cmdlist:
-            cmdlist[command] = text
-            self.c_commands[server.id] = cmdlist
-            dataIO.save_json(self.file_path, self.c_commands)
+            self.store.set((server.id, command), text)
+            self.bot.add_command_route(server.id, command, self.run_cc)
             await self.bot.say("Custom command successfully added.")
         else:
             await self.bot.say("This command already exists. Use "
@@ -64,9 +71,7 @@ class CustomCommands:
         if server.id in self.c_commands:
             cmdlist = self.c_commands[server.id]
             if command in cmdlist:
-                cmdlist[command] = text
-                self.c_commands[server.id] = cmdlist
-                dataIO.save_json(self.file_path, self.c_commands)
+                self.store.set((server.id, command), text)
                 await self.bot.say("Custom command successfully edited.")
             else:
                 await self.bot.say("That command doesn't exist. Use "
@@ -89,9 +94,9 @@ class CustomCommands:
         if server.id in self.c_commands:
             cmdlist = self.c_commands[server.id]
             if command in cmdlist:
-                cmdlist.pop(command, None)
-                self.c_commands[server.id] = cmdlist
-                dataIO.save_json(self.file_path, self.c_commands)
+                self.store.delete((server.id, command))
+                self.bot.remove_command_route(server.id, command,
+                                              self.run_cc)
                 await self.bot.say("Custom command successfully deleted.")
             else:
                 await self.bot.say("That command doesn't exist.")
@@ -121,33 +126,26 @@ class CustomCommands:
             for page in pagify(commands, delims=[" ", "\n"]):
                 await self.bot.whisper(box(page))
 
-    async def on_message(self, message):
-        if len(message.content) < 2 or message.channel.is_private:
-            return
-
+    async def run_cc(self, message, parsed):
+        """Routed by the bot to the messages invoking a custom command"""
         server = message.server
-        prefix = self.get_prefix(message)
+        prefix = parsed.prefix
 
-        if not prefix:
-            return
-
-        if server.id in self.c_commands and self.bot.user_allowed(message):
+        if server.id in self.c_commands:
             cmdlist = self.c_commands[server.id]
             cmd = message.content[len(prefix):]
             if cmd in cmdlist:
                 cmd = cmdlist[cmd]
                 cmd = self.format_cc(cmd, message)
-                await self.bot.send_message(message.channel, cmd)
+                await self.bot.send_message(message.channel, cmd, merge=True)
             elif cmd.lower() in cmdlist:
                 cmd = cmdlist[cmd.lower()]
                 cmd = self.format_cc(cmd, message)
-                await self.bot.send_message(message.channel, cmd)
+                await self.bot.send_message(message.channel, cmd, merge=True)
 
     def get_prefix(self, message):
-        for p in self.bot.settings.get_prefixes(message.server):
-            if message.content.startswith(p):
-                return p
-        return False
+        return self.bot.settings.match_prefix(message.server,
+                                              message.content)
 
     def format_cc(self, command, message):
         results = re.findall("\{([^}]+)\}", command)
@@ -189,12 +187,14 @@ def check_folders():
 
 def check_files():
     f = "data/customcom/commands.json"
+    dataIO.set_codec(f, "fast")
     if not dataIO.is_valid_json(f):
         print("Creating empty commands.json...")
         dataIO.save_json(f, {})
 
 
 def setup(bot):
-    check_folders()
-    check_files()
+    with bot.startup_profiler.phase(__name__ + " file checks"):
+        check_folders()
+        check_files()
     bot.add_cog(CustomCommands(bot))
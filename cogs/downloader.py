@@ -20,6 +20,8 @@ REPO_CLONE = 0x2
 REPO_SAME = 0x4
 REPOS_LIST = "https://twentysix26.github.io/Red-Docs/red_cog_approved_repos/"
 WINDOWS_OS = os.name == 'nt'
+# Imported on the first use of one of its commands, see Bot.load_extension
+LAZY = True
 
 DISCLAIMER = ("You're about to add a 3rd party repository. The creators of this bot"
               " and its community have no responsibility for any potential "
@@ -57,6 +59,9 @@ class Downloader:
     def save_repos(self):
         dataIO.save_json(self.file_path, self.repos)
 
+    async def save_repos_async(self):
+        await dataIO.save_json_async(self.file_path, self.repos)
+
     @commands.group(pass_context=True)
     @checks.is_owner()
     async def cog(self, ctx):
@@ -109,7 +114,7 @@ class Downloader:
             await self.bot.say(error_message)
             return
         self.populate_list(repo_name)
-        self.save_repos()
+        await self.save_repos_async()
         data = self.get_info_data(repo_name)
         if data:
             msg = data.get("INSTALL_MSG")
@@ -132,7 +137,7 @@ class Downloader:
             shutil.rmtree(os.path.join(self.path, repo_name), onerror=remove_readonly)
         except FileNotFoundError:
             pass
-        self.save_repos()
+        await self.save_repos_async()
         await self.bot.say("Repo '{}' removed.".format(repo_name))
 
     @cog.command(name="list")
@@ -376,7 +381,7 @@ class Downloader:
             return
         self.bot.set_cog("cogs." + cog, False)
         self.repos[repo_name][cog]['INSTALLED'] = False
-        self.save_repos()
+        await self.save_repos_async()
         os.remove(os.path.join("cogs", cog + ".py"))
         owner = self.bot.get_cog('Owner')
         await owner.unload.callback(owner, cog_name=cog)
@@ -468,7 +473,7 @@ class Downloader:
             distutils.dir_util.copy_tree(cog_data_path,
                                          os.path.join('data', cog))
         self.repos[repo_name][cog]['INSTALLED'] = True
-        self.save_repos()
+        await self.save_repos_async()
         if not reqs_failed:
             return True
         else:
@@ -705,7 +710,8 @@ def check_files():
 
 
 def setup(bot):
-    check_folders()
-    check_files()
+    with bot.startup_profiler.phase(__name__ + " file checks"):
+        check_folders()
+        check_files()
     n = Downloader(bot)
     bot.add_cog(n)
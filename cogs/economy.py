@@ -1,9 +1,9 @@
 import discord
 from discord.ext import commands
 from cogs.utils.dataIO import dataIO
-from collections import namedtuple, defaultdict, deque
+from cogs.utils.sqlite import SQLiteDB
+from collections import defaultdict, deque
 from datetime import datetime
-from copy import deepcopy
 from cogs.utils import checks
 from cogs.utils.chat_formatting import pagify, box
 from enum import Enum
@@ -15,6 +15,8 @@ import random
 default_settings = {"PAYDAY_TIME": 300, "PAYDAY_CREDITS": 120,
                     "SLOT_MIN": 5, "SLOT_MAX": 100, "SLOT_TIME": 0,
                     "REGISTER_CREDITS": 0}
+# Imported on the first use of one of its commands, see Bot.load_extension
+LAZY = True
 
 
 class EconomyError(Exception):
@@ -109,152 +111,307 @@ SLOT_PAYOUTS_MSG = ("Slot machine payouts:\n"
                     "Two symbols: Bet * 2".format(**SMReel.__dict__))
 
 
+class Account:
+    """A snapshot of a bank account
+
+    Accounts are never modified in place: the bank's methods update the
+    stored row and _replace returns an updated copy, so the same object
+    can safely be shared. created_at and member are resolved on first
+    access only."""
+
+    __slots__ = ("id", "name", "balance", "server", "_created_at",
+                 "_member")
+
+    def __init__(self, id, name, balance, created_at, server):
+        self.id = id
+        self.name = name
+        self.balance = balance
+        self.server = server
+        self._created_at = created_at
+        self._member = None
+
+    @property
+    def created_at(self):
+        if isinstance(self._created_at, str):
+            self._created_at = datetime.strptime(self._created_at,
+                                                 "%Y-%m-%d %H:%M:%S")
+        return self._created_at
+
+    @property
+    def member(self):
+        if self._member is None:
+            self._member = self.server.get_member(self.id)
+        return self._member
+
+    def _replace(self, **kwargs):
+        fields = {"id": self.id, "name": self.name, "balance": self.balance,
+                  "created_at": self._created_at, "server": self.server}
+        fields.update(kwargs)
+        return Account(**fields)
+
+    def __repr__(self):
+        return ("<Account id={0.id!r} name={0.name!r} balance={0.balance} "
+                "server={0.server!r}>".format(self))
+
+
+BANK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    server_id  TEXT NOT NULL,
+    user_id    TEXT NOT NULL,
+    name       TEXT NOT NULL,
+    balance    INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    present    INTEGER NOT NULL DEFAULT 1,  -- Still a member of the server
+    PRIMARY KEY (server_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS accounts_server_balance
+    ON accounts (server_id, balance DESC);
+CREATE INDEX IF NOT EXISTS accounts_balance ON accounts (balance DESC);
+CREATE TABLE IF NOT EXISTS legacy_accounts (
+    user_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL
+);
+"""
+
+
 class Bank:
 
     def __init__(self, bot, file_path):
-        self.accounts = dataIO.load_json(file_path)
+        self.db = SQLiteDB(file_path, schema=BANK_SCHEMA)
         self.bot = bot
+        columns = [r["name"] for r in
+                   self.db.fetchall("PRAGMA table_info(accounts)")]
+        if "present" not in columns:
+            self.db.execute("ALTER TABLE accounts ADD COLUMN present "
+                            "INTEGER NOT NULL DEFAULT 1")
+        self.db.execute("CREATE INDEX IF NOT EXISTS accounts_server_present"
+                        " ON accounts (server_id, present, balance DESC)")
+
+    def close(self):
+        self.db.close()
 
     def create_account(self, user, *, initial_balance=0):
         server = user.server
         if not self.account_exists(user):
-            if server.id not in self.accounts:
-                self.accounts[server.id] = {}
-            if user.id in self.accounts:  # Legacy account
-                balance = self.accounts[user.id]["balance"]
+            legacy = self.db.fetchone("SELECT balance FROM legacy_accounts "
+                                      "WHERE user_id = ?", (user.id,))
+            if legacy is not None:  # Legacy account
+                balance = legacy["balance"]
             else:
                 balance = initial_balance
             timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            account = {"name": user.name,
-                       "balance": balance,
-                       "created_at": timestamp
-                       }
-            self.accounts[server.id][user.id] = account
-            self._save_bank()
+            self.db.execute("INSERT INTO accounts (server_id, user_id, name, "
+                            "balance, created_at) VALUES (?, ?, ?, ?, ?)",
+                            (server.id, user.id, user.name, balance,
+                             timestamp))
             return self.get_account(user)
         else:
             raise AccountAlreadyExists()
 
     def account_exists(self, user):
-        try:
-            self._get_account(user)
-        except NoAccount:
-            return False
-        return True
+        row = self.db.fetchone("SELECT 1 FROM accounts "
+                               "WHERE server_id = ? AND user_id = ?",
+                               (user.server.id, user.id))
+        return row is not None
 
     def withdraw_credits(self, user, amount):
-        server = user.server
-
         if amount < 0:
             raise NegativeValue()
-
-        account = self._get_account(user)
-        if account["balance"] >= amount:
-            account["balance"] -= amount
-            self.accounts[server.id][user.id] = account
-            self._save_bank()
-        else:
-            raise InsufficientBalance()
+        self._withdraw(user, amount)
 
     def deposit_credits(self, user, amount):
-        server = user.server
         if amount < 0:
             raise NegativeValue()
-        account = self._get_account(user)
-        account["balance"] += amount
-        self.accounts[server.id][user.id] = account
-        self._save_bank()
+        self._deposit(user, amount)
 
     def set_credits(self, user, amount):
-        server = user.server
         if amount < 0:
             raise NegativeValue()
-        account = self._get_account(user)
-        account["balance"] = amount
-        self.accounts[server.id][user.id] = account
-        self._save_bank()
+        cursor = self.db.execute("UPDATE accounts SET balance = ? "
+                                 "WHERE server_id = ? AND user_id = ?",
+                                 (amount, user.server.id, user.id))
+        if cursor.rowcount == 0:
+            raise NoAccount()
 
     def transfer_credits(self, sender, receiver, amount):
         if amount < 0:
             raise NegativeValue()
         if sender is receiver:
             raise SameSenderAndReceiver()
-        if self.account_exists(sender) and self.account_exists(receiver):
-            sender_acc = self._get_account(sender)
-            if sender_acc["balance"] < amount:
-                raise InsufficientBalance()
-            self.withdraw_credits(sender, amount)
-            self.deposit_credits(receiver, amount)
-        else:
-            raise NoAccount()
+        with self.db.transaction():
+            if not self.account_exists(receiver):
+                raise NoAccount()
+            self._withdraw(sender, amount)
+            self._deposit(receiver, amount)
 
     def can_spend(self, user, amount):
-        account = self._get_account(user)
-        if account["balance"] >= amount:
+        if self.get_balance(user) >= amount:
             return True
         else:
             return False
 
     def wipe_bank(self, server):
-        self.accounts[server.id] = {}
-        self._save_bank()
+        self.db.execute("DELETE FROM accounts WHERE server_id = ?",
+                        (server.id,))
 
     def get_server_accounts(self, server):
-        if server.id in self.accounts:
-            raw_server_accounts = deepcopy(self.accounts[server.id])
-            accounts = []
-            for k, v in raw_server_accounts.items():
-                v["id"] = k
-                v["server"] = server
-                acc = self._create_account_obj(v)
-                accounts.append(acc)
-            return accounts
-        else:
-            return []
+        rows = self.db.fetchall("SELECT * FROM accounts WHERE server_id = ?",
+                                (server.id,))
+        return [self._create_account_obj(row, server) for row in rows]
 
     def get_all_accounts(self):
         accounts = []
-        for server_id, v in self.accounts.items():
-            server = self.bot.get_server(server_id)
+        for row in self.db.fetchall("SELECT * FROM accounts"):
+            server = self.bot.get_server(row["server_id"])
             if server is None:
                 # Servers that have since been left will be ignored
-                # Same for users_id from the old bank format
                 continue
-            raw_server_accounts = deepcopy(self.accounts[server.id])
-            for k, v in raw_server_accounts.items():
-                v["id"] = k
-                v["server"] = server
-                acc = self._create_account_obj(v)
-                accounts.append(acc)
+            accounts.append(self._create_account_obj(row, server))
+        return accounts
+
+    def set_present(self, member, present):
+        """Records whether the account's owner is still a member"""
+        self.db.execute("UPDATE accounts SET present = ? "
+                        "WHERE server_id = ? AND user_id = ?",
+                        (int(present), member.server.id, member.id))
+
+    def sync_members(self, server):
+        """Updates the present flags of the server's accounts, for the
+        members who joined or left while the cog wasn't listening"""
+        rows = self.db.fetchall("SELECT user_id, present FROM accounts "
+                                "WHERE server_id = ?", (server.id,))
+        changed = []
+        for row in rows:
+            present = int(server.get_member(row["user_id"]) is not None)
+            if present != row["present"]:
+                changed.append((present, server.id, row["user_id"]))
+        if changed:
+            with self.db.transaction():
+                self.db.executemany("UPDATE accounts SET present = ? "
+                                    "WHERE server_id = ? AND user_id = ?",
+                                    changed)
+
+    def get_server_leaderboard(self, server, top):
+        """Returns the server's richest accounts, up to top
+
+        Accounts are read in balance order from the index, and those of
+        members who left are skipped by it, so little else is loaded"""
+        accounts = []
+        rows = self.db.execute("SELECT * FROM accounts WHERE server_id = ? "
+                               "AND present = 1 ORDER BY balance DESC",
+                               (server.id,))
+        for row in rows:
+            acc = self._create_account_obj(row, server)
+            if acc.member is None:  # Excludes users who left
+                continue
+            accounts.append(acc)
+            if len(accounts) == top:
+                break
+        return accounts
+
+    def get_global_leaderboard(self, top):
+        """Returns the richest accounts of all servers, up to top
+
+        Users with accounts on multiple servers are listed only once,
+        with their highest balance"""
+        accounts = []
+        seen = set()
+        rows = self.db.execute("SELECT * FROM accounts "
+                               "ORDER BY balance DESC")
+        for row in rows:
+            if row["user_id"] in seen:
+                continue
+            server = self.bot.get_server(row["server_id"])
+            if server is None:  # Servers that have since been left
+                continue
+            acc = self._create_account_obj(row, server)
+            if acc.member is None:
+                continue
+            seen.add(acc.id)
+            accounts.append(acc)
+            if len(accounts) == top:
+                break
         return accounts
 
+    def get_rank(self, user):
+        """Returns the user's position in the server's leaderboard
+
+        Users with the same balance share the same rank. Like in the
+        leaderboard, members who left aren't counted"""
+        balance = self.get_balance(user)
+        row = self.db.fetchone("SELECT COUNT(*) FROM accounts "
+                               "WHERE server_id = ? AND present = 1 "
+                               "AND balance > ?",
+                               (user.server.id, balance))
+        return row[0] + 1
+
     def get_balance(self, user):
-        account = self._get_account(user)
-        return account["balance"]
+        row = self.db.fetchone("SELECT balance FROM accounts "
+                               "WHERE server_id = ? AND user_id = ?",
+                               (user.server.id, user.id))
+        if row is None:
+            raise NoAccount()
+        return row[0]
 
     def get_account(self, user):
-        acc = self._get_account(user)
-        acc["id"] = user.id
-        acc["server"] = user.server
-        return self._create_account_obj(acc)
-
-    def _create_account_obj(self, account):
-        account["member"] = account["server"].get_member(account["id"])
-        account["created_at"] = datetime.strptime(account["created_at"],
-                                                  "%Y-%m-%d %H:%M:%S")
-        Account = namedtuple("Account", "id name balance "
-                             "created_at server member")
-        return Account(**account)
-
-    def _save_bank(self):
-        dataIO.save_json("data/economy/bank.json", self.accounts)
+        row = self._get_account(user)
+        return self._create_account_obj(row, user.server)
+
+    def _create_account_obj(self, row, server):
+        return Account(row["user_id"], row["name"], row["balance"],
+                       row["created_at"], server)
+
+    def _withdraw(self, user, amount):
+        cursor = self.db.execute("UPDATE accounts SET balance = balance - ? "
+                                 "WHERE server_id = ? AND user_id = ? "
+                                 "AND balance >= ?",
+                                 (amount, user.server.id, user.id, amount))
+        if cursor.rowcount == 0:
+            if not self.account_exists(user):
+                raise NoAccount()
+            raise InsufficientBalance()
+
+    def _deposit(self, user, amount):
+        cursor = self.db.execute("UPDATE accounts SET balance = balance + ? "
+                                 "WHERE server_id = ? AND user_id = ?",
+                                 (amount, user.server.id, user.id))
+        if cursor.rowcount == 0:
+            raise NoAccount()
 
     def _get_account(self, user):
-        server = user.server
-        try:
-            return deepcopy(self.accounts[server.id][user.id])
-        except KeyError:
+        row = self.db.fetchone("SELECT * FROM accounts "
+                               "WHERE server_id = ? AND user_id = ?",
+                               (user.server.id, user.id))
+        if row is None:
             raise NoAccount()
+        return row
+
+
+def migrate_json_bank(json_path, db_path):
+    """One-shot import of the old bank.json into the bank database
+
+    The json file is renamed afterwards so this only ever runs once"""
+    data = dataIO.load_json(json_path)
+    accounts = []
+    legacy = []
+    for key, value in data.items():
+        if "balance" in value:  # Pre-server accounts format
+            legacy.append((key, value["balance"]))
+            continue
+        for user_id, acc in value.items():
+            accounts.append((key, user_id, acc["name"], acc["balance"],
+                             acc["created_at"]))
+    db = SQLiteDB(db_path, schema=BANK_SCHEMA)
+    try:
+        with db.transaction():
+            db.executemany("INSERT OR IGNORE INTO accounts (server_id, "
+                           "user_id, name, balance, created_at) "
+                           "VALUES (?, ?, ?, ?, ?)", accounts)
+            db.executemany("INSERT OR IGNORE INTO legacy_accounts "
+                           "(user_id, balance) VALUES (?, ?)", legacy)
+    finally:
+        db.close()
+    os.replace(json_path, json_path + ".migrated")
 
 
 class SetParser:
@@ -287,7 +444,7 @@ class Economy:
     def __init__(self, bot):
         global default_settings
         self.bot = bot
-        self.bank = Bank(bot, "data/economy/bank.json")
+        self.bank = Bank(bot, "data/economy/bank.db")
         self.file_path = "data/economy/settings.json"
         self.settings = dataIO.load_json(self.file_path)
         if "PAYDAY_TIME" in self.settings:  # old format
@@ -296,6 +453,24 @@ class Economy:
         self.settings = defaultdict(default_settings.copy, self.settings)
         self.payday_register = defaultdict(dict)
         self.slot_register = defaultdict(dict)
+        for server in list(self.bot.servers):  # If loaded after on_ready
+            self.bank.sync_members(server)
+
+    def __unload(self):
+        self.bank.close()
+
+    async def on_ready(self):
+        for server in list(self.bot.servers):
+            self.bank.sync_members(server)
+
+    async def on_server_join(self, server):
+        self.bank.sync_members(server)
+
+    async def on_member_join(self, member):
+        self.bank.set_present(member, True)
+
+    async def on_member_remove(self, member):
+        self.bank.set_present(member, False)
 
     @commands.group(name="bank", pass_context=True)
     async def _bank(self, ctx):
@@ -469,12 +644,8 @@ class Economy:
         server = ctx.message.server
         if top < 1:
             top = 10
-        bank_sorted = sorted(self.bank.get_server_accounts(server),
-                             key=lambda x: x.balance, reverse=True)
-        bank_sorted = [a for a in bank_sorted if a.member] #  exclude users who left
-        if len(bank_sorted) < top:
-            top = len(bank_sorted)
-        topten = bank_sorted[:top]
+        topten = self.bank.get_server_leaderboard(server, top)
+        top = len(topten)
         highscore = ""
         place = 1
         for acc in topten:
@@ -495,16 +666,8 @@ class Economy:
         Defaults to top 10"""
         if top < 1:
             top = 10
-        bank_sorted = sorted(self.bank.get_all_accounts(),
-                             key=lambda x: x.balance, reverse=True)
-        bank_sorted = [a for a in bank_sorted if a.member] #  exclude users who left
-        unique_accounts = []
-        for acc in bank_sorted:
-            if not self.already_in_list(unique_accounts, acc):
-                unique_accounts.append(acc)
-        if len(unique_accounts) < top:
-            top = len(unique_accounts)
-        topten = unique_accounts[:top]
+        topten = self.bank.get_global_leaderboard(top)
+        top = len(topten)
         highscore = ""
         place = 1
         for acc in topten:
@@ -519,11 +682,19 @@ class Economy:
         else:
             await self.bot.say("There are no accounts in the bank.")
 
-    def already_in_list(self, accounts, user):
-        for acc in accounts:
-            if user.id == acc.id:
-                return True
-        return False
+    @leaderboard.command(name="rank", pass_context=True, no_pm=True)
+    async def _rank(self, ctx, user: discord.Member=None):
+        """Shows a user's position in the server's leaderboard
+
+        Defaults to yours."""
+        user = user or ctx.message.author
+        try:
+            rank = self.bank.get_rank(user)
+        except NoAccount:
+            await self.bot.say("That user has no bank account.")
+            return
+        await self.bot.say("{} is #{} in this server's leaderboard."
+                           "".format(user.display_name, rank))
 
     @commands.command()
     async def payouts(self):
@@ -634,7 +805,7 @@ class Economy:
         server = ctx.message.server
         self.settings[server.id]["SLOT_MIN"] = bid
         await self.bot.say("Minimum bid is now {} credits.".format(bid))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     @economyset.command(pass_context=True)
     async def slotmax(self, ctx, bid: int):
@@ -642,7 +813,7 @@ class Economy:
         server = ctx.message.server
         self.settings[server.id]["SLOT_MAX"] = bid
         await self.bot.say("Maximum bid is now {} credits.".format(bid))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     @economyset.command(pass_context=True)
     async def slottime(self, ctx, seconds: int):
@@ -650,7 +821,7 @@ class Economy:
         server = ctx.message.server
         self.settings[server.id]["SLOT_TIME"] = seconds
         await self.bot.say("Cooldown is now {} seconds.".format(seconds))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     @economyset.command(pass_context=True)
     async def paydaytime(self, ctx, seconds: int):
@@ -659,7 +830,7 @@ class Economy:
         self.settings[server.id]["PAYDAY_TIME"] = seconds
         await self.bot.say("Value modified. At least {} seconds must pass "
                            "between each payday.".format(seconds))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     @economyset.command(pass_context=True)
     async def paydaycredits(self, ctx, credits: int):
@@ -668,7 +839,7 @@ class Economy:
         self.settings[server.id]["PAYDAY_CREDITS"] = credits
         await self.bot.say("Every payday will now give {} credits."
                            "".format(credits))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     @economyset.command(pass_context=True)
     async def registercredits(self, ctx, credits: int):
@@ -679,7 +850,7 @@ class Economy:
         self.settings[server.id]["REGISTER_CREDITS"] = credits
         await self.bot.say("Registering an account will now give {} credits."
                            "".format(credits))
-        dataIO.save_json(self.file_path, self.settings)
+        await dataIO.save_json_async(self.file_path, self.settings)
 
     # What would I ever do without stackoverflow?
     def display_time(self, seconds, granularity=2):
@@ -717,15 +888,16 @@ def check_files():
         dataIO.save_json(f, {})
 
     f = "data/economy/bank.json"
-    if not dataIO.is_valid_json(f):
-        print("Creating empty bank.json...")
-        dataIO.save_json(f, {})
+    if dataIO.is_valid_json(f):
+        print("Migrating bank.json to bank.db...")
+        migrate_json_bank(f, "data/economy/bank.db")
 
 
 def setup(bot):
     global logger
-    check_folders()
-    check_files()
+    with bot.startup_profiler.phase(__name__ + " file checks"):
+        check_folders()
+        check_files()
     logger = logging.getLogger("bot.economy")
     if logger.level == 0:
         # Prevents the logger from being loaded again in case of module reload
@@ -44,6 +44,11 @@ class General:
                      "Don't count on it", "My reply is no", "My sources say no", "Outlook not so good", "Very doubtful"]
         self.poll_sessions = []
 
+    def __unload(self):
+        for poll in self.poll_sessions:
+            self.bot.remove_channel_route(poll.channel.id,
+                                          self.check_poll_votes)
+
     @commands.command(hidden=True)
     async def ping(self):
         """Pong."""
@@ -342,6 +347,8 @@ class General:
             p = NewPoll(message, " ".join(text), self)
             if p.valid:
                 self.poll_sessions.append(p)
+                self.bot.add_channel_route(message.channel.id,
+                                           self.check_poll_votes)
                 await p.start()
             else:
                 await self.bot.say("poll question;option1;option2 (...)")
@@ -364,7 +371,7 @@ class General:
                 return poll
         return False
 
-    async def check_poll_votes(self, message):
+    async def check_poll_votes(self, message, parsed):
         if message.author.id != self.bot.user.id:
             if self.getPollByChannel(message):
                     self.getPollByChannel(message).checkAnswer(message)
@@ -382,6 +389,7 @@ class NewPoll():
         self.author = message.author.id
         self.client = main.bot
         self.poll_sessions = main.poll_sessions
+        self.vote_handler = main.check_poll_votes
         msg = [ans.strip() for ans in text.split(";")]
         if len(msg) < 2: # Needs at least one question and 2 choices
             self.valid = False
@@ -414,6 +422,7 @@ class NewPoll():
             msg += "*{}* - {} votes\n".format(data["ANSWER"], str(data["VOTES"]))
         await self.client.send_message(self.channel, msg)
         self.poll_sessions.remove(self)
+        self.client.remove_channel_route(self.channel.id, self.vote_handler)
 
     def checkAnswer(self, message):
         try:
@@ -429,5 +438,4 @@ class NewPoll():
 
 def setup(bot):
     n = General(bot)
-    bot.add_listener(n.check_poll_votes, "on_message")
     bot.add_cog(n)
@@ -13,7 +13,7 @@ from cogs.utils import checks
 from cogs.utils.converters import GlobalUser
 from cogs.utils.dataIO import dataIO
 from cogs.utils.chat_formatting import pagify, box
-from cogs.utils.embeds import BotHelpEmbed
+from cogs.utils.embeds import BotHelpEmbed, help_cache
 
 import importlib
 import traceback
@@ -24,6 +24,11 @@ import datetime
 import glob
 import os
 import aiohttp
+import cProfile
+import functools
+import io
+import pstats
+import types
 
 log = logging.getLogger("bot.owner")
 
@@ -48,6 +53,80 @@ class OwnerUnloadWithoutReloadError(CogUnloadError):
     pass
 
 
+@types.coroutine
+def _profiled(coro, profiler):
+    """Drives coro, enabling the profiler only while coro is running"""
+    value = error = None
+    while True:
+        profiler.enable()
+        try:
+            if error is not None:
+                future = coro.throw(error)
+            else:
+                future = coro.send(value)
+        except StopIteration as e:
+            return e.value
+        finally:
+            profiler.disable()
+        try:
+            value, error = (yield future), None
+        except BaseException as e:
+            value, error = None, e
+
+
+def _walk_commands(command):
+    yield command
+    for sub in set(getattr(command, "commands", {}).values()):
+        yield from _walk_commands(sub)
+
+
+class ProfileSession:
+    """Profiles the callbacks of some commands until stopped
+
+    Other tasks running while a profiled command awaits something are
+    left out of the results."""
+
+    def __init__(self, commands, invocations=None):
+        self.commands = commands
+        self.invocations = invocations
+        self.calls = 0
+        self.profiler = cProfile.Profile()
+        self.done = asyncio.Event()
+        self._originals = {}
+
+    def start(self):
+        for command in self.commands:
+            self._originals[command] = command.callback
+            command.callback = self._wrap(command.callback)
+
+    def stop(self):
+        for command, callback in self._originals.items():
+            command.callback = callback
+        self._originals.clear()
+        self.done.set()
+
+    def report(self, top=25):
+        if not self.calls:
+            return "No invocation was profiled."
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.strip_dirs().sort_stats("cumulative").print_stats(top)
+        return "{} invocation(s)\n{}".format(self.calls,
+                                              stream.getvalue().strip())
+
+    def _wrap(self, callback):
+        @functools.wraps(callback)
+        async def profiled(*args, **kwargs):
+            try:
+                return await _profiled(callback(*args, **kwargs),
+                                       self.profiler)
+            finally:
+                self.calls += 1
+                if self.invocations and self.calls >= self.invocations:
+                    self.done.set()
+        return profiled
+
+
 class Owner:
     """All owner-only commands that relate to debug bot operations."""
 
@@ -55,11 +134,24 @@ class Owner:
         self.bot = bot
         self.setowner_lock = False
         self.disabled_commands = dataIO.load_json("data/bot/disabled_commands.json")
-        self.global_ignores = dataIO.load_json("data/bot/global_ignores.json")
-        self.session = aiohttp.ClientSession(loop=self.bot.loop)
+        global_ignores = dataIO.load_json("data/bot/global_ignores.json")
+        # Kept as sets in memory for O(1) lookups on every message
+        self.global_ignores = {k: set(v) for k, v in global_ignores.items()}
+        self._session = None
+        self.profile_session = None
 
     def __unload(self):
-        self.session.close()
+        if self._session is not None:
+            self._session.close()
+        if self.profile_session is not None:
+            self.profile_session.stop()
+
+    @property
+    def session(self):
+        # Created on first use, most boots never need it
+        if self._session is None:
+            self._session = aiohttp.ClientSession(loop=self.bot.loop)
+        return self._session
 
     @commands.command()
     @checks.is_owner()
@@ -261,6 +353,88 @@ class Owner:
                         break
             await self.bot.say(box(page, lang="py"))
 
+    @commands.group(name="profile", pass_context=True, hidden=True)
+    @checks.is_owner()
+    async def _profile(self, ctx):
+        """Profiles commands while they're being used
+
+        The limit is a number of invocations, or a duration like 30s.
+        The slowest functions are shown once it's reached."""
+        if ctx.invoked_subcommand is None:
+            await self.bot.send_cmd_help(ctx)
+
+    @_profile.command(name="command", pass_context=True)
+    async def profile_command(self, ctx, limit: str, *, command: str):
+        """Profiles a command and its subcommands
+
+        Example: profile command 5 bank balance"""
+        comm_obj = self.bot.get_command(command)
+        if comm_obj is None:
+            await self.bot.say("That command doesn't seem to exist.")
+            return
+        await self._run_profile(ctx, limit, set(_walk_commands(comm_obj)))
+
+    @_profile.command(name="cog", pass_context=True)
+    async def profile_cog(self, ctx, limit: str, cog_name: str):
+        """Profiles every command of a cog
+
+        Example: profile cog 60s Economy"""
+        cog = self.bot.get_cog(cog_name)
+        if cog is None:
+            await self.bot.say("That cog doesn't seem to be loaded.")
+            return
+        excluded = set(_walk_commands(self._profile))
+        targets = set()
+        for comm_obj in set(self.bot.commands.values()):
+            for sub in _walk_commands(comm_obj):
+                if sub.instance is cog and sub not in excluded:
+                    targets.add(sub)
+        await self._run_profile(ctx, limit, targets)
+
+    @_profile.command(name="stop")
+    async def profile_stop(self):
+        """Stops profiling and shows the results"""
+        if self.profile_session is None:
+            await self.bot.say("Nothing is being profiled.")
+        else:
+            self.profile_session.done.set()
+
+    async def _run_profile(self, ctx, limit, targets):
+        if self.profile_session is not None:
+            await self.bot.say("Something is already being profiled. Use "
+                               "`{}profile stop` first.".format(ctx.prefix))
+            return
+        if not targets:
+            await self.bot.say("There's no command to profile.")
+            return
+        invocations = seconds = None
+        if limit.isdigit() and int(limit) > 0:
+            invocations = int(limit)
+        elif limit[:-1].isdigit() and limit.endswith("s") and \
+                int(limit[:-1]) > 0:
+            seconds = int(limit[:-1])
+        else:
+            await self.bot.send_cmd_help(ctx)
+            return
+
+        session = ProfileSession(targets, invocations)
+        self.profile_session = session
+        session.start()
+        await self.bot.say("Profiling {} command(s) for {}."
+                           "".format(len(targets),
+                                     limit + (" invocations" if invocations
+                                              else "")))
+        try:
+            await asyncio.wait_for(session.done.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            session.stop()
+            self.profile_session = None
+
+        for page in pagify(session.report(), shorten_by=16):
+            await self.bot.say(box(page, lang="py"))
+
     @commands.group(name="set", pass_context=True)
     async def _set(self, ctx):
         """Changes the bot's core settings"""
@@ -302,6 +476,7 @@ class Owner:
            This is used if a server-specific role is not set"""
         self.bot.settings.default_mod = role_name
         self.bot.settings.save_settings()
+        self.bot.invalidate_user_allowed()
         await self.bot.say("The default mod role name has been set.")
 
     @_set.command()
@@ -312,6 +487,7 @@ class Owner:
            This is used if a server-specific role is not set"""
         self.bot.settings.default_admin = role_name
         self.bot.settings.save_settings()
+        self.bot.invalidate_user_allowed()
         await self.bot.say("The default admin role name has been set.")
 
     @_set.command(pass_context=True)
@@ -521,6 +697,7 @@ class Owner:
         if server.id not in self.bot.settings.servers:
             await self.bot.say("Remember to set modrole too.")
         self.bot.settings.set_server_admin(server, role.name)
+        self.bot.invalidate_user_allowed()
         await self.bot.say("Admin role set to '{}'".format(role.name))
 
     @_set.command(name="modrole", pass_context=True, no_pm=True)
@@ -531,6 +708,7 @@ class Owner:
         if server.id not in self.bot.settings.servers:
             await self.bot.say("Remember to set adminrole too.")
         self.bot.settings.set_server_mod(server, role.name)
+        self.bot.invalidate_user_allowed()
         await self.bot.say("Mod role set to '{}'".format(role.name))
 
     @commands.group(pass_context=True)
@@ -546,8 +724,9 @@ class Owner:
     async def _blacklist_add(self, user: GlobalUser):
         """Adds user to the global blacklist"""
         if user.id not in self.global_ignores["blacklist"]:
-            self.global_ignores["blacklist"].append(user.id)
-            self.save_global_ignores()
+            self.global_ignores["blacklist"].add(user.id)
+            await self.save_global_ignores()
+            self.bot.invalidate_user_allowed(user.id)
             await self.bot.say("User has been blacklisted.")
         else:
             await self.bot.say("User is already blacklisted.")
@@ -557,7 +736,8 @@ class Owner:
         """Removes user from the global blacklist"""
         if user.id in self.global_ignores["blacklist"]:
             self.global_ignores["blacklist"].remove(user.id)
-            self.save_global_ignores()
+            await self.save_global_ignores()
+            self.bot.invalidate_user_allowed(user.id)
             await self.bot.say("User has been removed from the blacklist.")
         else:
             await self.bot.say("User is not blacklisted.")
@@ -576,8 +756,9 @@ class Owner:
     @blacklist.command(name="clear")
     async def _blacklist_clear(self):
         """Clears the global blacklist"""
-        self.global_ignores["blacklist"] = []
-        self.save_global_ignores()
+        self.global_ignores["blacklist"] = set()
+        await self.save_global_ignores()
+        self.bot.invalidate_user_allowed()
         await self.bot.say("Blacklist is now empty.")
 
     @commands.group(pass_context=True)
@@ -598,8 +779,12 @@ class Owner:
                 msg = "\nNon-whitelisted users will be ignored."
             else:
                 msg = ""
-            self.global_ignores["whitelist"].append(user.id)
-            self.save_global_ignores()
+            self.global_ignores["whitelist"].add(user.id)
+            await self.save_global_ignores()
+            if msg:  # Everyone else is ignored from now on
+                self.bot.invalidate_user_allowed()
+            else:
+                self.bot.invalidate_user_allowed(user.id)
             await self.bot.say("User has been whitelisted." + msg)
         else:
             await self.bot.say("User is already whitelisted.")
@@ -609,7 +794,11 @@ class Owner:
         """Removes user from global whitelist"""
         if user.id in self.global_ignores["whitelist"]:
             self.global_ignores["whitelist"].remove(user.id)
-            self.save_global_ignores()
+            await self.save_global_ignores()
+            if not self.global_ignores["whitelist"]:  # Everyone's allowed
+                self.bot.invalidate_user_allowed()
+            else:
+                self.bot.invalidate_user_allowed(user.id)
             await self.bot.say("User has been removed from the whitelist.")
         else:
             await self.bot.say("User is not whitelisted.")
@@ -628,8 +817,9 @@ class Owner:
     @whitelist.command(name="clear")
     async def _whitelist_clear(self):
         """Clears the global whitelist"""
-        self.global_ignores["whitelist"] = []
-        self.save_global_ignores()
+        self.global_ignores["whitelist"] = set()
+        await self.save_global_ignores()
+        self.bot.invalidate_user_allowed()
         await self.bot.say("Whitelist is now empty.")
 
     @commands.command()
@@ -686,8 +876,9 @@ class Owner:
         else:
             comm_obj.enabled = False
             comm_obj.hidden = True
+            help_cache.clear()
             self.disabled_commands.append(command)
-            self.save_disabled_commands()
+            await self.save_disabled_commands()
             await self.bot.say("Command has been disabled.")
 
     @command_disabler.command()
@@ -695,7 +886,7 @@ class Owner:
         """Enables commands/subcommands"""
         if command in self.disabled_commands:
             self.disabled_commands.remove(command)
-            self.save_disabled_commands()
+            await self.save_disabled_commands()
             await self.bot.say("Command enabled.")
         else:
             await self.bot.say("That command is not disabled.")
@@ -704,18 +895,13 @@ class Owner:
             comm_obj = await self.get_command(command)
             comm_obj.enabled = True
             comm_obj.hidden = False
+            help_cache.clear()
         except:  # In case it was in the disabled list but not currently loaded
             pass # No point in even checking what returns
 
     async def get_command(self, command):
-        command = command.split()
-        try:
-            comm_obj = self.bot.commands[command[0]]
-            if len(command) > 1:
-                command.pop(0)
-                for cmd in command:
-                    comm_obj = comm_obj.commands[cmd]
-        except KeyError:
+        comm_obj = self.bot.get_command(command)
+        if comm_obj is None:
             return KeyError
         for check in comm_obj.checks:
             if hasattr(check, "__name__") and check.__name__ == "is_owner_check":
@@ -730,6 +916,7 @@ class Owner:
                 cmd_obj.hidden = True
             except:
                 pass
+        help_cache.clear()
 
     @commands.command()
     @checks.is_owner()
@@ -801,8 +988,7 @@ class Owner:
             await self.bot.say("I have no owner set.")
             return
         server = ctx.message.server
-        owner = discord.utils.get(self.bot.get_all_members(),
-                                  id=self.bot.settings.owner)
+        owner = self.bot.user_index.get(self.bot.settings.owner)
         author = ctx.message.author
         footer = "User ID: " + author.id
 
@@ -841,11 +1027,11 @@ class Owner:
     @commands.command(pass_context=True)
     async def info(self, ctx):
         """Shows info about PieBot"""
-        embed = BotHelpEmbed(ctx)
+        embed = BotHelpEmbed.cached(ctx)
         owner_set = ctx.bot.settings.owner is not None
         owner = ctx.bot.settings.owner if owner_set else None
         if owner:
-            owner = discord.utils.get(ctx.bot.get_all_members(), id=owner)
+            owner = ctx.bot.user_index.get(owner)
             if not owner:
                 try:
                     owner = await ctx.bot.get_user_info(ctx.bot.settings.owner)
@@ -905,9 +1091,8 @@ class Owner:
         Returns a paginated list"""
         users = []
         total = len(_list)
-
-        for user_id in _list:
-            user = discord.utils.get(self.bot.get_all_members(), id=user_id)
+        for user_id in sorted(_list):
+            user = self.bot.user_index.get(user_id)
             if user:
                 users.append("{} ({})".format(user, user.id))
 
@@ -1044,11 +1229,13 @@ class Owner:
 
         return fmt.format(d=days, h=hours, m=minutes, s=seconds)
 
-    def save_global_ignores(self):
-        dataIO.save_json("data/bot/global_ignores.json", self.global_ignores)
+    async def save_global_ignores(self):
+        data = {k: sorted(v) for k, v in self.global_ignores.items()}
+        await dataIO.save_json_async("data/bot/global_ignores.json", data)
 
-    def save_disabled_commands(self):
-        dataIO.save_json("data/bot/disabled_commands.json", self.disabled_commands)
+    async def save_disabled_commands(self):
+        await dataIO.save_json_async("data/bot/disabled_commands.json",
+                                     self.disabled_commands)
 
 
 def _import_old_data(data):
@@ -34,6 +34,7 @@ def check_files():
 
 
 def setup(bot):
-    check_folders()
-    check_files()
+    with bot.startup_profiler.phase(__name__ + " file checks"):
+        check_folders()
+        check_files()
     bot.add_cog(TCG(bot))
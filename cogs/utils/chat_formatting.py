@@ -32,28 +32,80 @@ def italics(text):
 
 
 def pagify(text, delims=["\n"], *, escape=True, shorten_by=8,
-           page_length=2000):
-    """DOES NOT RESPECT MARKDOWN BOXES OR INLINE CODE"""
-    in_text = text
-    if escape:
-        num_mentions = text.count("@here") + text.count("@everyone")
-        shorten_by += num_mentions
+           page_length=2000, balance_boxes=False):
+    """Splits text into pages, cut at the last delimiter that fits
+
+    text can also be an iterable of strings, read only as needed. With
+    balance_boxes, a ``` box cut in two is closed at the end of the page
+    and reopened on the next one. DOES NOT RESPECT INLINE CODE"""
+    if isinstance(text, str):
+        chunks = iter(())
+        buffer = text
+    else:
+        chunks = iter(text)
+        buffer = ""
     page_length -= shorten_by
-    while len(in_text) > page_length:
-        closest_delim = max([in_text.rfind(d, 0, page_length)
-                             for d in delims])
-        closest_delim = closest_delim if closest_delim != -1 else page_length
+    pos = 0
+    reopen = ""
+    while True:
+        if len(buffer) - pos <= page_length:
+            parts = [buffer[pos:]]
+            size = len(parts[0])
+            for chunk in chunks:
+                parts.append(chunk)
+                size += len(chunk)
+                if size > page_length:
+                    break
+            buffer = "".join(parts)
+            pos = 0
+
+        room = page_length
+        if balance_boxes:
+            room -= len(reopen) + 1 + len("\n```")
+        end = min(pos + room, len(buffer))
         if escape:
-            to_send = escape_mass_mentions(in_text[:closest_delim])
-        else:
-            to_send = in_text[:closest_delim]
-        yield to_send
-        in_text = in_text[closest_delim:]
+            end -= (buffer.count("@here", pos, end) +
+                    buffer.count("@everyone", pos, end))
+        end = max(end, pos + 1)
 
-    if escape:
-        yield escape_mass_mentions(in_text)
-    else:
-        yield in_text
+        last = end >= len(buffer)
+        if last:
+            page = buffer[pos:]
+        else:
+            cut = max([buffer.rfind(d, pos + 1, end) for d in delims])
+            cut = cut if cut != -1 else end
+            page = buffer[pos:cut]
+            pos = cut
+
+        if reopen:
+            page = reopen + ("" if page.startswith("\n") else "\n") + page
+            reopen = ""
+        if balance_boxes:
+            lang = _unclosed_box(page)
+            if lang is not None and not last:
+                page += "\n```"
+                reopen = "```" + lang
+
+        yield escape_mass_mentions(page) if escape else page
+        if last:
+            return
+
+
+def _unclosed_box(text):
+    """Returns the language of the ``` box left open in text, or None"""
+    lang = None
+    start = text.find("```")
+    while start != -1:
+        if lang is None:
+            end = start + 3
+            while end < len(text) and text[end].isalnum():
+                end += 1
+            lang = text[start + 3:end]
+            start = text.find("```", end)
+        else:
+            lang = None
+            start = text.find("```", start + 3)
+    return lang
 
 
 def strikethrough(text):
@@ -1,4 +1,5 @@
 from discord.ext import commands
+from collections import OrderedDict
 import discord.utils
 
 #
@@ -8,6 +9,94 @@ import discord.utils
 #          https://github.com/Rapptz/RoboDanny/tree/async
 #
 
+# What a member is, as far as the checks are concerned
+SERVER_OWNER = 1
+ADMIN = 2
+MOD = 4
+
+
+class _Privileges:
+
+    __slots__ = ("roles", "permissions")
+
+    def __init__(self, roles):
+        self.roles = roles
+        self.permissions = {}  # channel id -> discord.Permissions
+
+
+class PrivilegeCache:
+    """The privileges of the members, resolved once instead of per check
+
+    For each (server, member) it keeps whether they own the server or
+    have its admin / mod role, and their permissions in the channels
+    they invoked commands in. The least recently used members are
+    dropped past maxsize. Must be invalidated when roles, channel
+    overwrites, the server's owner or the admin / mod settings change."""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def roles(self, ctx):
+        """Returns the SERVER_OWNER / ADMIN / MOD flags of the author"""
+        return self._entry(ctx).roles
+
+    def permissions(self, ctx):
+        """Returns the author's permissions in the channel"""
+        channel = ctx.message.channel
+        if ctx.message.server is None:
+            return channel.permissions_for(ctx.message.author)
+        permissions = self._entry(ctx).permissions
+        resolved = permissions.get(channel.id)
+        if resolved is None:
+            resolved = channel.permissions_for(ctx.message.author)
+            permissions[channel.id] = resolved
+        return resolved
+
+    def invalidate(self, server_id=None, member_id=None):
+        """Forgets a member of a server, a whole server, or everything"""
+        if server_id is None:
+            self._entries.clear()
+        elif member_id is not None:
+            self._entries.pop((server_id, member_id), None)
+        else:
+            for key in [k for k in self._entries if k[0] == server_id]:
+                del self._entries[key]
+
+    def _entry(self, ctx):
+        server = ctx.message.server
+        author = ctx.message.author
+        key = (server.id, author.id)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        entry = _Privileges(self._resolve_roles(ctx.bot.settings, server,
+                                                author))
+        self._entries[key] = entry
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def _resolve_roles(settings, server, author):
+        flags = 0
+        if server.owner is not None and author.id == server.owner.id:
+            flags |= SERVER_OWNER
+        names = {r.name.lower() for r in author.roles}
+        if settings.get_server_admin(server).lower() in names:
+            flags |= ADMIN
+        if settings.get_server_mod(server).lower() in names:
+            flags |= MOD
+        return flags
+
+
+privileges = PrivilegeCache()
+
+
 def is_owner_check(ctx):
     _id = ctx.message.author.id
     return _id == ctx.bot.settings.owner or _id in ctx.bot.settings.co_owners
@@ -31,9 +120,7 @@ def check_permissions(ctx, perms):
     elif not perms:
         return False
 
-    ch = ctx.message.channel
-    author = ctx.message.author
-    resolved = ch.permissions_for(author)
+    resolved = privileges.permissions(ctx)
     return all(getattr(resolved, name, None) == value for name, value in perms.items())
 
 def role_or_permissions(ctx, check, **perms):
@@ -48,20 +135,25 @@ def role_or_permissions(ctx, check, **perms):
     role = discord.utils.find(check, author.roles)
     return role is not None
 
+def privileges_or_permissions(ctx, flags, **perms):
+    """Like role_or_permissions, with the cached privilege flags"""
+    if check_permissions(ctx, perms):
+        return True
+
+    if ctx.message.channel.is_private:
+        return False # can't have roles in PMs
+
+    return bool(privileges.roles(ctx) & flags)
+
 def mod_or_permissions(**perms):
     def predicate(ctx):
-        server = ctx.message.server
-        mod_role = ctx.bot.settings.get_server_mod(server).lower()
-        admin_role = ctx.bot.settings.get_server_admin(server).lower()
-        return role_or_permissions(ctx, lambda r: r.name.lower() in (mod_role,admin_role), **perms)
+        return privileges_or_permissions(ctx, ADMIN | MOD, **perms)
 
     return commands.check(predicate)
 
 def admin_or_permissions(**perms):
     def predicate(ctx):
-        server = ctx.message.server
-        admin_role = ctx.bot.settings.get_server_admin(server)
-        return role_or_permissions(ctx, lambda r: r.name.lower() == admin_role.lower(), **perms)
+        return privileges_or_permissions(ctx, ADMIN, **perms)
 
     return commands.check(predicate)
 
@@ -69,10 +161,8 @@ def serverowner_or_permissions(**perms):
     def predicate(ctx):
         if ctx.message.server is None:
             return False
-        server = ctx.message.server
-        owner = server.owner
 
-        if ctx.message.author.id == owner.id:
+        if privileges.roles(ctx) & SERVER_OWNER:
             return True
 
         return check_permissions(ctx,perms)
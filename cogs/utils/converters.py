@@ -26,18 +26,23 @@ class GlobalUser(IDConverter):
         bot = self.ctx.bot
         match = self._get_id_match() or re.match(r'<@!?([0-9]+)>$', self.argument)
         server = message.server
+        index = getattr(bot, "user_index", None)
         result = None
         if match is None:
             # not a mention...
             if server:
                 result = server.get_member_named(self.argument)
-            if result is None:
+            if result is None and index is not None:
+                result = index.find_named(self.argument)
+            elif result is None:
                 result = _get_from_servers(bot, 'get_member_named', self.argument)
         else:
             user_id = match.group(1)
             if server:
                 result = server.get_member(user_id)
-            if result is None:
+            if result is None and index is not None:
+                result = index.get(user_id)
+            elif result is None:
                 result = _get_from_servers(bot, 'get_member', user_id)
 
         if result is None:
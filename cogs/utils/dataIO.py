@@ -1,55 +1,282 @@
 import json
 import os
 import logging
+import asyncio
+import atexit
+import hashlib
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 class InvalidFileIO(Exception):
     pass
 
+
+def _json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw.decode("utf-8"))
+
+def _msgpack_loads(raw):
+    if msgpack is None:
+        raise InvalidFileIO("The file is in msgpack format but msgpack "
+                            "is not installed")
+    try:
+        return msgpack.unpackb(raw, raw=False)
+    except Exception as e:
+        # Reported like any other corrupted file
+        raise json.decoder.JSONDecodeError(str(e), "", 0)
+
+# name: (encoder, decoder). Encoders return bytes
+CODECS = {
+    "pretty": (lambda data: json.dumps(data, indent=4, sort_keys=True,
+                                       separators=(',', ' : ')
+                                       ).encode("utf-8"),
+               _json_loads),
+    "compact": (lambda data: json.dumps(data, separators=(',', ':')
+                                        ).encode("utf-8"),
+                _json_loads)
+}
+
+if orjson is not None:
+    CODECS["orjson"] = (orjson.dumps, orjson.loads)
+
+if msgpack is not None:
+    CODECS["msgpack"] = (lambda data: msgpack.packb(data, use_bin_type=True),
+                         _msgpack_loads)
+
+# First bytes a json document can start with
+_JSON_START = frozenset(b' \t\r\n{["-0123456789tfn')
+
 class DataIO():
     def __init__(self):
         self.logger = logging.getLogger("bot")
+        # Seconds between each flush of the files saved with defer=True
+        self.write_behind_interval = 5
+        self._dirty = {}
+        self._versions = {}
+        self._written = {}
+        self._replace_lock = threading.Lock()
+        self._file_locks = {}
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        self._codecs = {}
+        # "checksum" verifies writes by hashing the bytes read back and
+        # keeps the hash in a sidecar file. "parse" reparses the file
+        self.integrity = "checksum"
+        # Journal records after which a journaled store gets compacted
+        self.compact_after = 500
+        self._journaled = {}
+        # writes, written_bytes, write_seconds and failed_writes
+        self.stats = Counter()
+        atexit.register(self.flush)
+
+    def set_codec(self, filename, codec):
+        """Sets how a file is serialized from now on
+
+        codec is the name of one of the CODECS: "pretty" (the default),
+        "compact", "orjson" or "msgpack", the last two being available
+        only if installed. "fast" picks orjson if possible, compact json
+        otherwise. Files are read correctly whatever codec wrote them."""
+        if codec == "fast":
+            codec = "orjson" if "orjson" in CODECS else "compact"
+        if codec not in CODECS:
+            raise InvalidFileIO("Unknown or unavailable codec: "
+                                "{}".format(codec))
+        self._codecs[os.path.normpath(filename)] = codec
+
+    def open_journaled(self, filename):
+        """Loads a json file as a JournaledStore
+
+        The store is compacted in the background by write_behind"""
+        store = JournaledStore(self, filename)
+        old = self._journaled.get(store.filename)
+        if old is not None:
+            old.close()
+        self._journaled[store.filename] = store
+        return store
+
+    def save_json(self, filename, data, *, defer=False):
+        """Atomically saves json file
+
+        If defer is True the file is only marked as dirty and will be
+        written by the next flush. Many deferred saves of the same file
+        are coalesced into a single write."""
+        filename = os.path.normpath(filename)
+        if defer:
+            self._dirty[filename] = data
+            return True
+        self._dirty.pop(filename, None)  # Superseded by this save
+        return self._write_json(filename, *self._snapshot(filename, data))
+
+    async def save_json_async(self, filename, data):
+        """Atomically saves json file without blocking the event loop
+
+        The data is serialized right away on the loop's thread, since
+        the cogs keep mutating it, while writing runs in the DataIO
+        executor. Saves of the same file are performed in the order
+        they were requested."""
+        filename = os.path.normpath(filename)
+        self._dirty.pop(filename, None)
+        loop = asyncio.get_event_loop()
+        payload, version = self._snapshot(filename, data)
+        if filename not in self._file_locks:
+            self._file_locks[filename] = asyncio.Lock()
+        async with self._file_locks[filename]:
+            return await loop.run_in_executor(self._executor,
+                                              self._write_json,
+                                              filename, payload, version)
+
+    def load_json(self, filename):
+        """Loads json file"""
+        self._flush_file(filename)
+        return self._read_json(filename)
+
+    def is_valid_json(self, filename):
+        """Verifies if json file exists / is readable
+
+        Files whose checksum matches their sidecar are not parsed"""
+        self._flush_file(filename)
+        if self._matches_checksum(filename):
+            return True
+        try:
+            self._read_json(filename)
+            return True
+        except FileNotFoundError:
+            return False
+        except json.decoder.JSONDecodeError:
+            return False
+
+    def flush(self):
+        """Writes all the dirty files to disk"""
+        for filename in list(self._dirty):
+            self._flush_file(filename)
+
+    async def flush_async(self, loop):
+        """Writes all the dirty files to disk without blocking the loop
+
+        The data is serialized on the loop's thread, since the cogs keep
+        mutating it, while writing and replacing happen in the executor"""
+        for filename in list(self._dirty):
+            data = self._dirty.pop(filename, None)
+            if data is None:
+                continue
+            payload, version = self._snapshot(filename, data)
+            await loop.run_in_executor(self._executor, self._write_json,
+                                       filename, payload, version)
+
+    async def write_behind(self, loop):
+        """Periodically flushes the dirty files. Runs as a task"""
+        while True:
+            await asyncio.sleep(self.write_behind_interval)
+            try:
+                await self.flush_async(loop)
+                for store in list(self._journaled.values()):
+                    if store.records >= self.compact_after:
+                        await store.compact_async(loop)
+            except Exception:
+                self.logger.exception("Failed to flush the pending "
+                                      "data writes.")
 
-    def save_json(self, filename, data):
-        """Atomically saves json file"""
+    def _flush_file(self, filename):
+        filename = os.path.normpath(filename)
+        data = self._dirty.pop(filename, None)
+        if data is not None:
+            self._write_json(filename, *self._snapshot(filename, data))
+
+    def _snapshot(self, filename, data):
+        return self._dumps(data, filename), self._next_version(filename)
+
+    def _next_version(self, filename):
+        version = self._versions.get(filename, 0) + 1
+        self._versions[filename] = version
+        return version
+
+    def _write_json(self, filename, payload, version):
+        start = time.perf_counter()
         rnd = randint(1000, 9999)
         path, ext = os.path.splitext(filename)
         tmp_file = "{}-{}.tmp".format(path, rnd)
-        self._save_json(tmp_file, data)
+        digest = hashlib.sha256(payload).hexdigest()
+        with open(tmp_file, mode="wb") as f:
+            f.write(payload)
         try:
-            self._read_json(tmp_file)
+            if self.integrity == "parse":
+                self._read_json(tmp_file)
+            elif self._file_checksum(tmp_file) != digest:
+                raise json.decoder.JSONDecodeError("Checksum mismatch",
+                                                   "", 0)
         except json.decoder.JSONDecodeError:
             self.logger.exception("Attempted to write file {} but JSON "
                                   "integrity check on tmp file has failed. "
                                   "The original file is unaltered."
                                   "".format(filename))
+            os.remove(tmp_file)
+            with self._replace_lock:
+                self.stats["failed_writes"] += 1
             return False
-        os.replace(tmp_file, filename)
+        with self._replace_lock:
+            self.stats["writes"] += 1
+            self.stats["written_bytes"] += len(payload)
+            self.stats["write_seconds"] += time.perf_counter() - start
+            # A newer snapshot may have been written in the meantime
+            if self._written.get(filename, 0) > version:
+                os.remove(tmp_file)
+                return True
+            os.replace(tmp_file, filename)
+            self._written[filename] = version
+            # Written last: if we crash before this the sidecar is stale
+            # and is_valid_json simply falls back to parsing the file
+            with open(filename + ".sha256", mode="w") as f:
+                f.write(digest)
         return True
 
-    def load_json(self, filename):
-        """Loads json file"""
-        return self._read_json(filename)
+    def _file_checksum(self, filename):
+        sha = hashlib.sha256()
+        with open(filename, mode="rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
 
-    def is_valid_json(self, filename):
-        """Verifies if json file exists / is readable"""
+    def _matches_checksum(self, filename):
         try:
-            self._read_json(filename)
-            return True
-        except FileNotFoundError:
-            return False
-        except json.decoder.JSONDecodeError:
+            with open(filename + ".sha256", mode="r") as f:
+                expected = f.read().strip()
+            return self._file_checksum(filename) == expected
+        except OSError:
             return False
 
     def _read_json(self, filename):
-        with open(filename, encoding='utf-8', mode="r") as f:
-            data = json.load(f)
-        return data
+        with open(filename, mode="rb") as f:
+            raw = f.read()
+        return self._loads(raw)
+
+    def _loads(self, raw):
+        if raw.startswith(b"\xef\xbb\xbf"):  # utf-8 BOM
+            raw = raw[3:]
+        # Without msgpack, anything that isn't json is a corrupted file
+        if msgpack is None or not raw or raw[0] in _JSON_START:
+            return _json_loads(raw)
+        return _msgpack_loads(raw)
+
+    def _dumps(self, data, filename=None):
+        codec = self._codecs.get(filename, "pretty")
+        return CODECS[codec][0](data)
 
     def _save_json(self, filename, data):
-        with open(filename, encoding='utf-8', mode="w") as f:
-            json.dump(data, f, indent=4,sort_keys=True,
-                separators=(',',' : '))
+        with open(filename, mode="wb") as f:
+            f.write(self._dumps(data, os.path.normpath(filename)))
         return data
 
     def _legacy_fileio(self, filename, IO, data=None):
@@ -64,9 +291,137 @@ class DataIO():
             raise InvalidFileIO("FileIO was called with invalid"
                 " parameters")
 
+class JournaledStore:
+    """A json file updated through an append-only journal
+
+    data holds the whole document, but it must only be modified through
+    set and delete: each change is appended to <file>.journal as a small
+    record instead of rewriting the file. On load the journal is replayed
+    over the snapshot, and compact folds it into a new snapshot."""
+
+    def __init__(self, dataio, filename):
+        self.filename = os.path.normpath(filename)
+        self.journal_path = self.filename + ".journal"
+        self._old_journal_path = self.journal_path + ".old"
+        self._dataio = dataio
+        self._compacting = False
+        try:
+            self.data = dataio.load_json(self.filename)
+        except FileNotFoundError:
+            self.data = {}
+        # A leftover .old journal comes from an unfinished compaction
+        self.records = self._replay(self._old_journal_path)
+        self.records += self._replay(self.journal_path)
+        self._journal = self._open_journal()
+
+    def set(self, keys, value):
+        """Sets the value at the path of nested keys
+
+        Missing intermediate dicts are created"""
+        record = ["set", list(keys), value]
+        self._apply(record)
+        self._append(record)
+
+    def delete(self, keys):
+        """Deletes the value at the path of nested keys, if any"""
+        parent = self.data
+        for key in keys[:-1]:
+            parent = parent.get(key)
+            if parent is None:
+                return
+        if keys[-1] in parent:
+            record = ["del", list(keys)]
+            self._apply(record)
+            self._append(record)
+
+    def compact(self):
+        """Writes a new snapshot and discards the folded journal"""
+        payload, version = self._rotate()
+        if self._dataio._write_json(self.filename, payload, version):
+            os.remove(self._old_journal_path)
+
+    async def compact_async(self, loop):
+        """Like compact, but the snapshot is written in the executor"""
+        if self._compacting:
+            return
+        self._compacting = True
+        try:
+            payload, version = self._rotate()
+            written = await loop.run_in_executor(self._dataio._executor,
+                                                 self._dataio._write_json,
+                                                 self.filename, payload,
+                                                 version)
+            if written:
+                os.remove(self._old_journal_path)
+        finally:
+            self._compacting = False
+
+    def close(self):
+        self._journal.close()
+        if self._dataio._journaled.get(self.filename) is self:
+            del self._dataio._journaled[self.filename]
+
+    def _apply(self, record):
+        op, keys = record[0], record[1]
+        parent = self.data
+        for key in keys[:-1]:
+            parent = parent.setdefault(key, {})
+        if op == "set":
+            parent[keys[-1]] = record[2]
+        elif op == "del":
+            parent.pop(keys[-1], None)
+
+    def _append(self, record):
+        self._journal.write(json.dumps(record, separators=(',', ':')))
+        self._journal.write("\n")
+        self._journal.flush()
+        self.records += 1
+
+    def _replay(self, path):
+        count = 0
+        try:
+            f = open(path, encoding="utf-8", mode="r")
+        except FileNotFoundError:
+            return count
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Torn write, the process died mid-append
+                self._apply(record)
+                count += 1
+        return count
+
+    def _open_journal(self):
+        journal = open(self.journal_path, encoding="utf-8", mode="a+")
+        if journal.tell():
+            journal.seek(journal.tell() - 1)
+            if journal.read(1) != "\n":  # Isolates a torn record
+                journal.write("\n")
+        return journal
+
+    def _rotate(self):
+        # Records are idempotent, so replaying the old journal over the
+        # new snapshot is harmless if we crash before deleting it
+        self._journal.close()
+        if os.path.exists(self._old_journal_path):
+            with open(self.journal_path, encoding="utf-8", mode="r") as f:
+                pending = f.read()
+            with open(self._old_journal_path, encoding="utf-8",
+                      mode="a") as f:
+                f.write(pending)
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self._old_journal_path)
+        self._journal = self._open_journal()
+        self.records = 0
+        # Serialized right away so that the snapshot matches the journal
+        return self._dataio._snapshot(self.filename, self.data)
+
+
 def get_value(filename, key):
-    with open(filename, encoding='utf-8', mode="r") as f:
-        data = json.load(f)
+    data = dataIO.load_json(filename)
     return data[key]
 
 def set_value(filename, key, value):
@@ -1,11 +1,66 @@
 import inspect
 import discord
+from collections import OrderedDict
 from discord.ext.commands.formatter import HelpFormatter, Paginator
 from discord.ext.commands.core import Command
 from discord import Embed
 from datetime import datetime
 from cogs.utils.colors import BOT
 from cogs.utils.chat_formatting import inline_list
+from cogs.utils import checks
+
+
+class HelpCache:
+    """The static parts of the rendered help embeds
+
+    Entries are keyed by what they're rendered from, the least recently
+    used ones are dropped past maxsize. Must be cleared when commands
+    are added or removed, or when the prefixes change."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        parts = self._entries.get(key)
+        if parts is not None:
+            self._entries.move_to_end(key)
+        return parts
+
+    def put(self, key, parts):
+        self._entries[key] = parts
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+help_cache = HelpCache()
+
+
+def _prefix_key(ctx):
+    bot = ctx.bot
+    server = ctx.message.server
+    return (ctx.prefix, tuple(bot.settings.prefixes),
+            tuple(bot.settings.get_server_prefixes(server)))
+
+
+def _visible_key(ctx, command_or_cog):
+    """What decides the subcommands the author can see, which change
+    the rendering. Their checks look at who the author is, so that's
+    compared instead of evaluating them"""
+    if isinstance(command_or_cog, Command) and \
+            not hasattr(command_or_cog, "commands"):
+        return ()
+    server = ctx.message.server
+    if server is None:
+        return ("private", checks.is_owner_check(ctx))
+    if checks.is_owner_check(ctx):
+        return ("owner",)
+    return (server.id, checks.privileges.roles(ctx),
+            checks.privileges.permissions(ctx).value)
+
 
 class Formatter(HelpFormatter):
     def __init__(self):
@@ -46,6 +101,7 @@ class RichEmbed(Embed):
         author = ctx.message.author
         bot = ctx.bot
 
+        self._color = kwargs['color']
         if kwargs['color'] is 'bot':
             kwargs['color'] = BOT
         elif kwargs['color'] is 'author':
@@ -63,14 +119,47 @@ class RichEmbed(Embed):
 
     # You can ignore this.
     def __len__(self):
-        def clean(arr):
-            return [v for v in arr if not not v]
-
-        values = ([f.name for f in self.fields] + 
-                  [f.value for f in self.fields] + 
-                  [self.title, self.description, self.author.name, self.footer.text])
-        
-        return sum(clean([len(v) for v in values]))
+        total = 0
+        for field in self.fields:
+            total += len(field.name) + len(field.value)
+        for value in (self.title, self.description, self.author.name,
+                      self.footer.text):
+            if value:
+                total += len(value)
+        return total
+
+    @classmethod
+    def cached(cls, ctx, *args):
+        """Returns cls(ctx, *args), reusing the rendering of a previous
+        identical request. Only the author, footer and timestamp are
+        made anew
+
+        Requires cls to define a cache_key(ctx, *args) classmethod,
+        returning what the rendering depends on"""
+        key = (cls.__name__,) + cls.cache_key(ctx, *args)
+        parts = help_cache.get(key)
+        if parts is None:
+            embed = cls(ctx, *args)
+            help_cache.put(key, embed.static_parts())
+            return embed
+        return cls.from_parts(ctx, parts)
+
+    def static_parts(self):
+        fields = tuple((f.name, f.value, f.inline) for f in self.fields)
+        return (self.title, self.description, self._color,
+                self.thumbnail.url, fields)
+
+    @classmethod
+    def from_parts(cls, ctx, parts):
+        title, description, color, thumbnail, fields = parts
+        embed = cls.__new__(cls)
+        RichEmbed.__init__(embed, ctx, title=title, description=description,
+                           color=color)
+        if thumbnail:
+            embed.set_thumbnail(url=thumbnail)
+        for name, value, inline in fields:
+            embed.add_field(name=name, value=value, inline=inline)
+        return embed
 
 
 class HelpEmbed(RichEmbed):
@@ -87,6 +176,7 @@ class HelpEmbed(RichEmbed):
             s_prefixes = s_prefixes if s_prefixes else "--/--"
 
         cogs = [type(c).__name__ for c in bot.cogs.values()]
+        cogs += getattr(bot, "deferred_cogs", [])
 
         wiki = "[bot's wiki](https://github.com/Quantomistro3178/PieBot/wiki)"
         support = "[support server](https://discord.gg/rEM9gFN)"
@@ -105,6 +195,10 @@ class HelpEmbed(RichEmbed):
         self.add_field(name="Server Prefixes", value=s_prefixes)
         self.add_field(name="Cogs", value="```{}```".format(",  ".join(cogs)), inline=False)
 
+    @classmethod
+    def cache_key(cls, ctx):
+        return _prefix_key(ctx) + (ctx.bot.user.avatar_url,)
+
 
 class CmdHelpEmbed(RichEmbed):
     """Help embed for bot commands"""
@@ -125,6 +219,11 @@ class CmdHelpEmbed(RichEmbed):
         self.add_field(name="Cog", value=cog)
         self.add_field(name="Base Command", value=base_cmd)
         self.add_field(name="Command Usage:", value=codeblock, inline=False)
+
+    @classmethod
+    def cache_key(cls, ctx, command):
+        return (command.qualified_name,) + _prefix_key(ctx) + \
+            _visible_key(ctx, command)
         
 class CmdUsageEmbed(RichEmbed):
     """Command Usage embed"""
@@ -137,6 +236,11 @@ class CmdUsageEmbed(RichEmbed):
                               description=codeblock,
                               color='bot')
 
+    @classmethod
+    def cache_key(cls, ctx, command):
+        return (command.qualified_name,) + _prefix_key(ctx) + \
+            _visible_key(ctx, command)
+
 class CogHelpEmbed(RichEmbed):
     """Help embed for cogs"""
     def __init__(self, ctx, cog):
@@ -150,6 +254,11 @@ class CogHelpEmbed(RichEmbed):
                               description="{0}\n{1}".format(descrip, codeblock),
                               color='bot')
 
+    @classmethod
+    def cache_key(cls, ctx, cog):
+        return (type(cog).__name__,) + _prefix_key(ctx) + \
+            _visible_key(ctx, cog)
+
 
 class BotHelpEmbed(RichEmbed):
     """Help embed for the bot itself"""
@@ -173,3 +282,7 @@ class BotHelpEmbed(RichEmbed):
         self.add_field(name="PieBot Version", value=ctx.bot.version)
         self.add_field(name="License", value="[GPL-3.0 License](https://github.com/Quantomistro3178/PieBot/blob/master/LICENSE)")
         self.add_field(name="Wiki", value="[Link](https://github.com/Quantomistro3178/PieBot/wiki)")
+
+    @classmethod
+    def cache_key(cls, ctx):
+        return (ctx.bot.version,)
@@ -0,0 +1,168 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import asyncio
+import logging
+import re
+import time
+
+
+log = logging.getLogger("bot.metrics")
+
+PREFIX = "piebot_"
+# Upper bounds in seconds, an implicit +Inf bucket follows
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+def _metric_name(name):
+    return PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append('{}="{}"'.format(key, value.replace("\n", "\\n")))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Histogram:
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Collects the bot's operational metrics
+
+    The bot's counter is exported as is, next to labelled counters,
+    latency histograms and gauges. render() returns everything in the
+    Prometheus text format, serve() exposes it over HTTP."""
+
+    def __init__(self, counter, dataio=None):
+        self.counter = counter
+        self.dataio = dataio
+        self._histograms = {}
+        self._gauges = {}
+        self._counters = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observes how long the block took, even if it raised"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def inc(self, name, value=1, **labels):
+        """Increments a labelled counter. Label values must come from a
+        bounded set, every combination is its own series"""
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self):
+        lines = []
+        for name, value in sorted(self.counter.items()):
+            name = _metric_name(name) + "_total"
+            lines.append("# TYPE {} counter".format(name))
+            lines.append("{} {}".format(name, value))
+
+        if self.dataio is not None:
+            for name, value in sorted(self.dataio.stats.items()):
+                name = _metric_name("dataio_" + name) + "_total"
+                lines.append("# TYPE {} counter".format(name))
+                lines.append("{} {}".format(name, value))
+
+        typed = set()
+        for (name, labels), value in sorted(self._counters.items()):
+            name = _metric_name(name) + "_total"
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} counter".format(name))
+            lines.append("{}{} {}".format(name, _format_labels(labels),
+                                          value))
+
+        for (name, labels), value in sorted(self._gauges.items()):
+            name = _metric_name(name)
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} gauge".format(name))
+            lines.append("{}{} {}".format(name, _format_labels(labels),
+                                          value))
+
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            name = _metric_name(name)
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} histogram".format(name))
+            cumulative = 0
+            bounds = list(histogram.buckets) + ["+Inf"]
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    name, _format_labels(labels, [("le", bound)]),
+                    cumulative))
+            lines.append("{}_sum{} {}".format(name, _format_labels(labels),
+                                              histogram.sum))
+            lines.append("{}_count{} {}".format(name, _format_labels(labels),
+                                                histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def observe_loop_lag(self, lag):
+        """Records how late the loop woke up from a sleep"""
+        self.observe("loop_lag_seconds", lag)
+        self.set_gauge("loop_lag_last_seconds", lag)
+
+    async def serve(self, host, port):
+        """Serves render() over HTTP at /metrics"""
+        server = await asyncio.start_server(self._handle, host, port)
+        log.info("Serving metrics on http://{}:{}/metrics".format(host, port))
+        return server
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # Headers aren't needed
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and \
+                    parts[1].split("?")[0] == "/metrics":
+                status = "200 OK"
+                body = self.render().encode("utf-8")
+            else:
+                status = "404 Not Found"
+                body = b"Not found\n"
+            writer.write("HTTP/1.0 {}\r\n"
+                         "Content-Type: text/plain; version=0.0.4\r\n"
+                         "Content-Length: {}\r\n\r\n"
+                         "".format(status, len(body)).encode("latin-1"))
+            writer.write(body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,198 @@
+import logging
+import re
+import time
+
+
+log = logging.getLogger("bot")
+# Numbered backreferences would point to the wrong group once fused
+_NUMBERED_BACKREF = re.compile(r"\\[1-9]|\(\?\(\d")
+
+
+class Modifier:
+    """A message modifier and its statistics
+
+    Either a callable, or a regex replacement like re.sub's. Callables
+    declared pure must return a str, the result of the others is
+    converted with str()."""
+
+    def __init__(self, func=None, *, pattern=None, repl=None, pure=False):
+        self.func = func
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        self.repl = repl
+        self.pure = pure
+        if func is not None:
+            self.name = getattr(func, "__qualname__", repr(func))
+        else:
+            self.name = "regex:" + self.pattern.pattern
+        self.enabled = True
+        self.calls = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self._failed_in_a_row = 0
+        self._slow_in_a_row = 0
+
+    def __call__(self, content):
+        if self.pattern is not None:
+            return self.pattern.sub(self.repl, content)
+        result = self.func(content)
+        return result if self.pure else str(result)
+
+    def expand(self, match):
+        """Returns the replacement of a match found by a fused pattern"""
+        own = self.pattern.match(match.string, match.start())
+        if callable(self.repl):
+            return self.repl(own)
+        return own.expand(self.repl)
+
+
+class _FusedRegex:
+    """Applies consecutive regex modifiers in a single pass
+
+    Each modifier doesn't see the replacements made by the others"""
+
+    def __init__(self, modifiers):
+        self.modifiers = modifiers
+        self.name = "regex:fused({})".format(len(modifiers))
+        self.current = None
+        self._groups = {}
+        parts = []
+        for i, modifier in enumerate(modifiers):
+            group = "_m{}".format(i)
+            self._groups[group] = modifier
+            parts.append("(?P<{}>{})".format(group, modifier.pattern.pattern))
+        self.regex = re.compile("|".join(parts), modifiers[0].pattern.flags)
+
+    def __call__(self, content):
+        self.current = None
+        return self.regex.sub(self._replace, content)
+
+    def _replace(self, match):
+        self.current = self._groups[match.lastgroup]
+        return self.current.expand(match)
+
+
+class ModifierPipeline:
+    """The message modifiers, compiled into the stages run on a message
+
+    Every stage is timed. A modifier failing max_failures times in a
+    row, or taking more than slow_threshold seconds max_slow times in
+    a row, is disabled."""
+
+    def __init__(self, metrics=None, max_failures=5, slow_threshold=0.05,
+                 max_slow=20):
+        self.metrics = metrics
+        self.max_failures = max_failures
+        self.slow_threshold = slow_threshold
+        self.max_slow = max_slow
+        self.modifiers = []
+        self._stages = []
+
+    def __len__(self):
+        return len(self._stages)
+
+    def add(self, modifier):
+        self.modifiers.append(modifier)
+        self._compile()
+
+    def find(self, func):
+        """Returns the Modifier registered for func, or func itself if
+        it's a registered Modifier. None if there's none"""
+        for modifier in self.modifiers:
+            # == since bound methods are new objects on every access
+            if modifier is func or modifier.func == func:
+                return modifier
+        return None
+
+    def remove(self, modifier):
+        self.modifiers.remove(modifier)
+        self._compile()
+
+    def clear(self):
+        self.modifiers.clear()
+        self._compile()
+
+    def apply(self, content):
+        for stage in self._stages:
+            start = time.perf_counter()
+            try:
+                result = stage(content)
+            except Exception as e:
+                modifier = stage
+                if isinstance(stage, _FusedRegex):
+                    modifier = stage.current
+                self._failed(modifier, e)
+                continue
+            elapsed = time.perf_counter() - start
+            content = result
+            if self.metrics is not None:
+                self.metrics.observe("message_modifier_seconds", elapsed,
+                                     modifier=stage.name)
+            if isinstance(stage, Modifier):
+                self._succeeded(stage, elapsed)
+            else:
+                for modifier in stage.modifiers:
+                    modifier._failed_in_a_row = 0
+        return content
+
+    def _succeeded(self, modifier, elapsed):
+        modifier.calls += 1
+        modifier.seconds += elapsed
+        modifier._failed_in_a_row = 0
+        if elapsed > self.slow_threshold:
+            modifier._slow_in_a_row += 1
+            if modifier._slow_in_a_row >= self.max_slow:
+                self._disable(modifier, "it is too slow ({:.3f}s)"
+                                        "".format(elapsed))
+        else:
+            modifier._slow_in_a_row = 0
+
+    def _failed(self, modifier, error):
+        if modifier is None:
+            return
+        modifier.calls += 1
+        modifier.failures += 1
+        modifier._failed_in_a_row += 1
+        if self.metrics is not None:
+            self.metrics.counter["message_modifier_failures"] += 1
+        if modifier._failed_in_a_row >= self.max_failures:
+            self._disable(modifier, "it keeps failing ({}: {})"
+                                    "".format(type(error).__name__, error))
+
+    def _disable(self, modifier, reason):
+        modifier.enabled = False
+        log.warning("Message modifier {} disabled because {}"
+                    "".format(modifier.name, reason))
+        if self.metrics is not None:
+            self.metrics.counter["message_modifiers_disabled"] += 1
+        self._compile()
+
+    def _compile(self):
+        stages = []
+        regexes = []
+        for modifier in self.modifiers:
+            if not modifier.enabled:
+                continue
+            fusable = (modifier.pattern is not None and not
+                       _NUMBERED_BACKREF.search(modifier.pattern.pattern))
+            if fusable and (not regexes or
+                            regexes[0].pattern.flags ==
+                            modifier.pattern.flags):
+                regexes.append(modifier)
+                continue
+            stages.extend(self._fuse(regexes))
+            regexes = []
+            if fusable:
+                regexes.append(modifier)
+            else:
+                stages.append(modifier)
+        stages.extend(self._fuse(regexes))
+        self._stages = stages
+
+    @staticmethod
+    def _fuse(regexes):
+        if len(regexes) < 2:
+            return regexes
+        try:
+            return [_FusedRegex(regexes)]
+        except re.error:  # Such as global flags in the middle of a pattern
+            return regexes
@@ -0,0 +1,126 @@
+from collections import OrderedDict, deque
+import asyncio
+import time
+
+
+MAX_LENGTH = 2000
+# Discord lets a channel receive 5 messages every 5 seconds. The actual
+# buckets aren't exposed by discord.py, so this is a fixed approximation
+RATE = 5
+PER = 5.0
+
+
+class _Outgoing:
+
+    __slots__ = ("destination", "content", "kwargs", "merge", "future")
+
+    def __init__(self, destination, content, kwargs, merge, future):
+        self.destination = destination
+        self.content = content
+        self.kwargs = kwargs
+        self.merge = merge and not kwargs and isinstance(content, str)
+        self.future = future
+
+
+class SendQueue:
+    """Sends the messages of each channel in order, one at a time
+
+    Sends are spaced to stay within rate messages every per seconds per
+    channel, approximating Discord's limit, instead of waiting for it to
+    refuse them. Consecutive mergeable messages waiting in the same
+    queue are sent as a single one, as long as it fits in 2000
+    characters; each of their senders gets that message.
+
+    sender is the coroutine function actually sending a message."""
+
+    def __init__(self, sender, metrics=None, rate=RATE, per=PER):
+        self._sender = sender
+        self._metrics = metrics
+        self.rate = rate
+        self.per = per
+        self._queues = {}
+        self._workers = {}
+        # channel -> times of its last sends, least recently used first
+        self._sent = OrderedDict()
+        self.depth = 0
+
+    async def send(self, destination, content, kwargs, merge=False):
+        key = getattr(destination, "id", destination)
+        future = asyncio.Future()
+        item = _Outgoing(destination, content, kwargs, merge, future)
+        self._queues.setdefault(key, deque()).append(item)
+        self._set_depth(1)
+        if key not in self._workers:
+            self._workers[key] = asyncio.ensure_future(self._drain(key))
+        return await future
+
+    def channel_depth(self, destination):
+        key = getattr(destination, "id", destination)
+        return len(self._queues.get(key, ()))
+
+    async def _drain(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                await self._wait_for_slot(key)
+                batch = self._next_batch(queue)
+                self._set_depth(-len(batch))
+                first = batch[0]
+                content = first.content
+                if len(batch) > 1:
+                    content = "\n".join(i.content for i in batch)
+                    if self._metrics is not None:
+                        self._metrics.counter["send_queue_merged"] += \
+                            len(batch) - 1
+                try:
+                    result = await self._sender(first.destination, content,
+                                                **first.kwargs)
+                except Exception as e:
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+                else:
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_result(result)
+        finally:
+            del self._workers[key]
+            if not queue:
+                del self._queues[key]
+            self._set_depth(0)
+
+    def _next_batch(self, queue):
+        batch = [queue.popleft()]
+        if not batch[0].merge:
+            return batch
+        length = len(batch[0].content)
+        while queue and queue[0].merge:
+            length += len(queue[0].content) + 1
+            if length > MAX_LENGTH:
+                break
+            batch.append(queue.popleft())
+        return batch
+
+    async def _wait_for_slot(self, key):
+        sent = self._sent.pop(key, None)
+        if sent is None:
+            sent = deque(maxlen=self.rate)
+        self._sent[key] = sent
+        if len(sent) == self.rate:
+            delay = sent[0] + self.per - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        now = time.monotonic()
+        sent.append(now)
+        # Forget the channels that have been quiet for a whole period
+        while True:
+            oldest, times = next(iter(self._sent.items()))
+            if oldest == key or times[-1] + self.per > now:
+                break
+            del self._sent[oldest]
+
+    def _set_depth(self, change):
+        self.depth += change
+        if self._metrics is not None:
+            self._metrics.set_gauge("send_queue_depth", self.depth)
+            self._metrics.set_gauge("send_queue_channels", len(self._queues))
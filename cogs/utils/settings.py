@@ -1,13 +1,42 @@
 from .dataIO import dataIO
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
 from copy import deepcopy
 import discord
 import os
+import re
 import argparse
 
 
 default_path = "data/bot/settings.json"
 
 
+class ServerIndex(Mapping):
+    """Read-only view of the per-server settings
+
+    Membership and len() only look at the index, sections are loaded
+    when they're actually accessed"""
+
+    def __init__(self, settings):
+        self._settings = settings
+
+    def __contains__(self, sid):
+        return sid in self._settings._server_ids
+
+    def __getitem__(self, sid):
+        section = self._settings._server_section(sid)
+        if section is None:
+            raise KeyError(sid)
+        return section
+
+    def __iter__(self):
+        return iter(list(self._settings._server_ids))
+
+    def __len__(self):
+        return len(self._settings._server_ids)
+
+
 class Settings:
 
     def __init__(self, path=default_path, parse_args=True):
@@ -22,20 +51,39 @@ class Settings:
                         "PREFIXES": []}
                         }
         self._memory_only = False
+        # Compiled per server, the least recently used ones dropped past
+        # server_cache_size like the server sections
+        self._prefix_matchers = OrderedDict()
+        self._last_prefix_match = None
+        # Called with what changed, "prefixes" or "roles" (admin / mod),
+        # and the server id, None if it's every server, so the bot can
+        # drop what depends on it
+        self.change_hooks = []
+        # Server sections live in their own files and only the recently
+        # used ones are kept in memory
+        self.server_cache_size = 256
+        self._server_ids = self._load_server_index()
+        self._server_cache = OrderedDict()
+        # Only what actually changed gets written, see save_settings()
+        self._dirty = False
+        self._dirty_servers = set()
+        self._batch_depth = 0
 
         if not dataIO.is_valid_json(self.path):
             self.bot_settings = deepcopy(self.default_settings)
+            self._dirty = True
             self.save_settings()
         else:
             current = dataIO.load_json(self.path)
-            if current.keys() != self.default_settings.keys():
-                for key in self.default_settings.keys():
-                    if key not in current.keys():
-                        current[key] = self.default_settings[key]
-                        print("Adding " + str(key) +
-                              " field to settings.json")
-                dataIO.save_json(self.path, current)
-            self.bot_settings = dataIO.load_json(self.path)
+            changed = self._split_servers(current)
+            for key in self.default_settings.keys():
+                if key not in current.keys():
+                    current[key] = self.default_settings[key]
+                    print("Adding " + str(key) + " field to settings.json")
+                    changed = True
+            self.bot_settings = current
+            self._dirty = changed
+            self.save_settings()
 
         if parse_args:
             self.parse_cmd_arguments()
@@ -74,6 +122,22 @@ class Settings:
         parser.add_argument("--debug",
                             action="store_true",
                             help="Enables debug mode")
+        parser.add_argument("--save-interval", type=float, default=5,
+                            help="Seconds between each write of the data "
+                                 "files whose saving is deferred, such as "
+                                 "the bank")
+        parser.add_argument("--metrics-port", type=int,
+                            help="Serves the bot's metrics in the "
+                                 "Prometheus format on "
+                                 "http://127.0.0.1:<port>/metrics")
+        parser.add_argument("--lag-threshold", type=float, default=1.0,
+                            help="Seconds the event loop can be blocked "
+                                 "before what's blocking it gets logged")
+        parser.add_argument("--profile-startup",
+                            action="store_true",
+                            help="Prints how long each step of the boot "
+                                 "took, including each cog's import and "
+                                 "setup")
 
         args = parser.parse_args()
 
@@ -91,19 +155,109 @@ class Settings:
         self.debug = args.debug
         self._dry_run = args.dry_run
         self.co_owners = args.co_owner
+        self.save_interval = args.save_interval
+        self.profile_startup = args.profile_startup
+        self.metrics_port = args.metrics_port
+        self.lag_threshold = args.lag_threshold
 
         self.save_settings()
 
     def check_folders(self):
-        folders = ("data", os.path.dirname(self.path), "cogs", "cogs/utils")
+        folders = ("data", os.path.dirname(self.path), self.servers_path,
+                   "cogs", "cogs/utils")
         for folder in folders:
             if not os.path.exists(folder):
                 print("Creating " + folder + " folder...")
                 os.makedirs(folder)
 
     def save_settings(self):
-        if not self._memory_only:
+        """Writes the settings that changed since the last save
+
+        Does nothing inside a batch(), everything is written once the
+        outermost batch ends"""
+        if self._memory_only or self._batch_depth:
+            return
+        if self._dirty:
             dataIO.save_json(self.path, self.bot_settings)
+            self._dirty = False
+        for sid in self._dirty_servers:
+            self._save_server(sid)
+        self._dirty_servers.clear()
+
+    @contextmanager
+    def batch(self):
+        """Groups several changes into a single save"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            self.save_settings()
+
+    def _set(self, section, key, value):
+        """Sets section[key], returns True if the value changed"""
+        if key in section and section[key] == value:
+            return False
+        section[key] = value
+        return True
+
+    def _set_global(self, key, value):
+        if self._set(self.bot_settings, key, value):
+            self._dirty = True
+
+    def _set_server(self, sid, key, value):
+        if sid not in self._server_ids:
+            self._new_server(sid)
+        if self._set(self._server_section(sid), key, value):
+            self._dirty_servers.add(sid)
+
+    @property
+    def servers_path(self):
+        return os.path.join(os.path.dirname(self.path), "servers")
+
+    def _server_file(self, sid):
+        return os.path.join(self.servers_path, sid + ".json")
+
+    def _load_server_index(self):
+        return {f[:-5] for f in os.listdir(self.servers_path)
+                if f.endswith(".json") and f[:-5].isdigit()}
+
+    def _split_servers(self, current):
+        """Moves the server sections of an old settings.json to their
+        own files. Returns True if there were any"""
+        server_ids = [k for k in current if str(k).isdigit()]
+        for sid in server_ids:
+            section = current.pop(sid)
+            if sid not in self._server_ids:
+                dataIO.save_json(self._server_file(sid), section)
+                self._server_ids.add(sid)
+        return bool(server_ids)
+
+    def _server_section(self, sid):
+        """Returns the server's settings, None if it has none"""
+        if sid not in self._server_ids:
+            return None
+        section = self._server_cache.get(sid)
+        if section is not None:
+            self._server_cache.move_to_end(sid)
+            return section
+        section = dataIO.load_json(self._server_file(sid))
+        self._cache_server(sid, section)
+        return section
+
+    def _cache_server(self, sid, section):
+        self._server_cache[sid] = section
+        # Sections that were never written must stay in memory
+        while (len(self._server_cache) > self.server_cache_size and
+               not self._memory_only):
+            old_sid, old = self._server_cache.popitem(last=False)
+            if old_sid in self._dirty_servers:
+                dataIO.save_json(self._server_file(old_sid), old)
+                self._dirty_servers.discard(old_sid)
+
+    def _save_server(self, sid):
+        if sid in self._server_cache:
+            dataIO.save_json(self._server_file(sid), self._server_cache[sid])
 
     @property
     def owner(self):
@@ -111,7 +265,7 @@ class Settings:
 
     @owner.setter
     def owner(self, value):
-        self.bot_settings["OWNER"] = value
+        self._set_global("OWNER", value)
 
     @property
     def token(self):
@@ -119,7 +273,13 @@ class Settings:
 
     @token.setter
     def token(self, value):
-        self.bot_settings["TOKEN"] = value
+        self._set_global("TOKEN", value)
+
+    @property
+    def first_run(self):
+        """True until a token, an owner, prefixes or a server is set"""
+        return (not self.bot_settings["TOKEN"] and self.owner is None and
+                not self.prefixes and not self._server_ids)
 
     @property
     def login_credentials(self):
@@ -135,7 +295,8 @@ class Settings:
     @prefixes.setter
     def prefixes(self, value):
         assert isinstance(value, list)
-        self.bot_settings["PREFIXES"] = value
+        self._set_global("PREFIXES", value)
+        self._invalidate_prefixes()
 
     @property
     def default_admin(self):
@@ -143,7 +304,9 @@ class Settings:
 
     @default_admin.setter
     def default_admin(self, value):
-        self.bot_settings["default"]["ADMIN_ROLE"] = value
+        if self._set(self.bot_settings["default"], "ADMIN_ROLE", value):
+            self._dirty = True
+            self._changed("roles")
 
     @property
     def default_mod(self):
@@ -151,70 +314,71 @@ class Settings:
 
     @default_mod.setter
     def default_mod(self, value):
-        self.bot_settings["default"]["MOD_ROLE"] = value
+        if self._set(self.bot_settings["default"], "MOD_ROLE", value):
+            self._dirty = True
+            self._changed("roles")
 
     @property
     def servers(self):
-        ret = {}
-        server_ids = list(
-            filter(lambda x: str(x).isdigit(), self.bot_settings))
-        for server in server_ids:
-            ret.update({server: self.bot_settings[server]})
-        return ret
+        return ServerIndex(self)
 
     def get_server(self, server):
         if server is None:
             return self.bot_settings["default"].copy()
         assert isinstance(server, discord.Server)
-        return self.bot_settings.get(server.id,
-                                     self.bot_settings["default"]).copy()
+        section = self._server_section(server.id)
+        if section is None:
+            section = self.bot_settings["default"]
+        return section.copy()
 
     def get_server_admin(self, server):
         if server is None:
             return self.default_admin
         assert isinstance(server, discord.Server)
-        if server.id not in self.bot_settings:
+        section = self._server_section(server.id)
+        if section is None:
             return self.default_admin
-        return self.bot_settings[server.id].get("ADMIN_ROLE", "")
+        return section.get("ADMIN_ROLE", "")
 
     def set_server_admin(self, server, value):
         if server is None:
             return
         assert isinstance(server, discord.Server)
-        if server.id not in self.bot_settings:
-            self.add_server(server.id)
-        self.bot_settings[server.id]["ADMIN_ROLE"] = value
+        self._set_server(server.id, "ADMIN_ROLE", value)
+        self._changed("roles", server.id)
         self.save_settings()
 
     def get_server_mod(self, server):
         if server is None:
             return self.default_mod
         assert isinstance(server, discord.Server)
-        if server.id not in self.bot_settings:
+        section = self._server_section(server.id)
+        if section is None:
             return self.default_mod
-        return self.bot_settings[server.id].get("MOD_ROLE", "")
+        return section.get("MOD_ROLE", "")
 
     def set_server_mod(self, server, value):
         if server is None:
             return
         assert isinstance(server, discord.Server)
-        if server.id not in self.bot_settings:
-            self.add_server(server.id)
-        self.bot_settings[server.id]["MOD_ROLE"] = value
+        self._set_server(server.id, "MOD_ROLE", value)
+        self._changed("roles", server.id)
         self.save_settings()
 
     def get_server_prefixes(self, server):
-        if server is None or server.id not in self.bot_settings:
+        section = None
+        if server is not None:
+            section = self._server_section(server.id)
+        if section is None:
             return self.prefixes
-        return self.bot_settings[server.id].get("PREFIXES", [])
+        return section.get("PREFIXES", [])
 
     def set_server_prefixes(self, server, prefixes):
         if server is None:
             return
         assert isinstance(server, discord.Server)
-        if server.id not in self.bot_settings:
-            self.add_server(server.id)
-        self.bot_settings[server.id]["PREFIXES"] = prefixes
+        self._set_server(server.id, "PREFIXES", prefixes)
+        self._invalidate_prefixes(server.id)
         self.save_settings()
 
     def get_prefixes(self, server):
@@ -222,6 +386,53 @@ class Settings:
         p = self.get_server_prefixes(server)
         return p if p else self.prefixes
 
+    def match_prefix(self, server, content):
+        """Returns the prefix content starts with, None if there's none
+
+        The server's prefixes are compiled into a single pattern, longest
+        first. The last result is remembered, since the same message is
+        checked by the core and by the cogs listening to messages."""
+        key = server.id if server is not None else None
+        last = self._last_prefix_match
+        if last is not None and last[0] == key and last[1] is content:
+            return last[2]
+        if key in self._prefix_matchers:
+            self._prefix_matchers.move_to_end(key)
+        else:
+            self._prefix_matchers[key] = self._compile_prefixes(server)
+            if len(self._prefix_matchers) > self.server_cache_size:
+                self._prefix_matchers.popitem(last=False)
+        matcher = self._prefix_matchers[key]
+        match = matcher.match(content) if matcher is not None else None
+        prefix = match.group(0) if match is not None else None
+        self._last_prefix_match = (key, content, prefix)
+        return prefix
+
+    def _compile_prefixes(self, server):
+        prefixes = sorted(set(self.get_prefixes(server)), key=len,
+                          reverse=True)
+        if not prefixes:
+            return None
+        return re.compile("|".join(re.escape(p) for p in prefixes))
+
+    def _invalidate_prefixes(self, sid=None):
+        self._changed("prefixes", sid)
+        if sid is None:  # Global prefixes affect every server
+            self._prefix_matchers.clear()
+        else:
+            self._prefix_matchers.pop(sid, None)
+        self._last_prefix_match = None
+
+    def _changed(self, what, sid=None):
+        for hook in self.change_hooks:
+            hook(what, sid)
+
     def add_server(self, sid):
-        self.bot_settings[sid] = self.bot_settings["default"].copy()
+        self._new_server(sid)
         self.save_settings()
+
+    def _new_server(self, sid):
+        self._server_ids.add(sid)
+        self._cache_server(sid, self.bot_settings["default"].copy())
+        self._dirty_servers.add(sid)
+        self._invalidate_prefixes(sid)
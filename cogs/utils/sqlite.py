@@ -0,0 +1,52 @@
+from contextlib import contextmanager
+import sqlite3
+
+
+class SQLiteDB:
+    """Small wrapper around a sqlite3 connection
+
+    Statements executed outside of transaction() are committed on their
+    own, so single-row updates don't need any extra handling. Use
+    transaction() to group several statements atomically."""
+
+    def __init__(self, path, *, schema=None):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        # WAL avoids an fsync per commit while keeping the file consistent
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        if schema:
+            self.conn.executescript(schema)
+
+    def execute(self, query, params=()):
+        return self.conn.execute(query, params)
+
+    def executemany(self, query, seq_of_params):
+        return self.conn.executemany(query, seq_of_params)
+
+    def fetchone(self, query, params=()):
+        return self.conn.execute(query, params).fetchone()
+
+    def fetchall(self, query, params=()):
+        return self.conn.execute(query, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """Commits everything executed in the block, or nothing at all
+
+        Nested calls join the outermost transaction"""
+        if self.conn.in_transaction:
+            yield self
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        else:
+            self.conn.execute("COMMIT")
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,99 @@
+from collections import Counter
+
+
+def _is_named(member, name):
+    if len(name) > 5 and name[-5] == "#" and \
+            name[:-5] == member.name and name[-4:] == member.discriminator:
+        return True
+    return member.name == name or member.nick == name
+
+
+class UserIndex:
+    """Every member the bot can see, by id and by name
+
+    Rebuilt when the bot gets ready and kept up to date from the member
+    and server events, so resolving a user doesn't mean asking every
+    server in turn. Names are indexed as name#discriminator, name and
+    nickname, matched like discord.py's get_member_named does."""
+
+    def __init__(self):
+        # user id -> {server id: (member, the names it's indexed under)}
+        self._members = {}
+        self._names = {}  # name -> Counter of user ids
+
+    def __len__(self):
+        return len(self._members)
+
+    def rebuild(self, members):
+        self._members.clear()
+        self._names.clear()
+        for member in members:
+            self.add(member)
+
+    def add(self, member):
+        self.remove(member)
+        keys = {member.name, "{}#{}".format(member.name,
+                                            member.discriminator)}
+        if member.nick:
+            keys.add(member.nick)
+        servers = self._members.setdefault(member.id, {})
+        servers[member.server.id] = (member, keys)
+        for name in keys:
+            self._names.setdefault(name, Counter())[member.id] += 1
+
+    def remove(self, member):
+        servers = self._members.get(member.id)
+        if servers is None:
+            return
+        entry = servers.pop(member.server.id, None)
+        if not servers:
+            del self._members[member.id]
+        if entry is None:
+            return
+        for name in entry[1]:
+            ids = self._names[name]
+            ids[member.id] -= 1
+            if ids[member.id] <= 0:
+                del ids[member.id]
+            if not ids:
+                del self._names[name]
+
+    def get(self, user_id, server=None):
+        """Returns a member with that id, from server if possible"""
+        servers = self._members.get(user_id)
+        if not servers:
+            return None
+        if server is not None and server.id in servers:
+            return servers[server.id][0]
+        return next(iter(servers.values()))[0]
+
+    def find_named(self, name, server=None):
+        """Returns a member named name, from server if possible
+
+        name can be name#discriminator, a name or a nickname"""
+        found = None
+        for user_id in self._names.get(name, ()):
+            for sid, (member, _) in self._members[user_id].items():
+                if not _is_named(member, name):
+                    continue
+                if server is None or sid == server.id:
+                    return member
+                found = found or member
+        return found
+
+    async def on_member_join(self, member):
+        self.add(member)
+
+    async def on_member_remove(self, member):
+        self.remove(member)
+
+    async def on_member_update(self, before, after):
+        self.add(after)
+
+    async def on_server_join(self, server):
+        for member in server.members:
+            self.add(member)
+
+    async def on_server_remove(self, server):
+        for member in server.members:
+            self.remove(member)
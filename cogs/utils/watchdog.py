@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+
+log = logging.getLogger("bot")
+
+
+def _current_task(loop):
+    if hasattr(asyncio, "current_task"):
+        return asyncio.current_task(loop)
+    return asyncio.Task.current_task(loop)
+
+
+class LoopWatchdog:
+    """Reports what is blocking the event loop
+
+    A coroutine running on the loop refreshes a heartbeat. A separate
+    thread checks it and, once the loop has been stuck for longer than
+    threshold seconds, logs the running task, the command being invoked
+    and the loop thread's stack. Each stall is reported once, counted
+    in the bot's counter and in the loop_stalls_by_command metric. The
+    heartbeat's delays are recorded as the loop lag metrics."""
+
+    def __init__(self, bot, threshold=1.0, interval=0.25):
+        self.bot = bot
+        self.threshold = threshold
+        self.interval = interval
+        self._beat = None
+        self._reported_beat = None
+        self._loop_thread = None
+        self._thread = None
+
+    def start(self):
+        self.bot.loop.create_task(self._heartbeat())
+
+    async def _heartbeat(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch,
+                                            name="loop-watchdog",
+                                            daemon=True)
+            self._thread.start()
+        while True:
+            await asyncio.sleep(self.interval)
+            beat = time.monotonic()
+            lag = max(0.0, beat - self._beat - self.interval)
+            self._beat = beat
+            self.bot.metrics.observe_loop_lag(lag)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            beat = self._beat
+            lag = time.monotonic() - beat - self.interval
+            if lag > self.threshold and beat != self._reported_beat:
+                self._reported_beat = beat
+                try:
+                    self._report(lag)
+                except Exception as e:
+                    log.exception("The loop watchdog failed", exc_info=e)
+
+    def _report(self, lag):
+        frame = sys._current_frames().get(self._loop_thread)
+        task = _current_task(self.bot.loop)
+        coro = getattr(task, "_coro", None)
+        running = getattr(coro, "__qualname__", repr(task))
+        command = self._find_command(frame)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        log.warning("Event loop blocked for {:.2f}s in {} (command: {})\n{}"
+                    "".format(lag, running, command or "none", stack))
+        self.bot.loop.call_soon_threadsafe(self._count, command)
+
+    def _count(self, command):
+        self.bot.counter["loop_stalls"] += 1
+        self.bot.metrics.inc("loop_stalls_by_command",
+                             command=command or "none")
+
+    @staticmethod
+    def _find_command(frame):
+        """Returns the qualified name of the command invoked by the
+        innermost frame that has a ctx, if any"""
+        while frame is not None:
+            ctx = frame.f_locals.get("ctx")
+            command = getattr(ctx, "command", None)
+            if command is not None:
+                return getattr(command, "qualified_name", None)
+            frame = frame.f_back
+        return None
@@ -7,7 +7,10 @@ import logging.handlers
 import traceback
 import datetime
 import subprocess
+import time
 import re
+import importlib
+from contextlib import contextmanager
 
 try:
     from discord.ext import commands
@@ -19,11 +22,16 @@ except ImportError:
           "https://twentysix26.github.io/Red-Docs/\n")
     sys.exit(1)
 
-from cogs.utils import embeds
+from cogs.utils import checks, embeds
 from cogs.utils.settings import Settings
 from cogs.utils.dataIO import dataIO
 from cogs.utils.chat_formatting import inline
-from collections import Counter
+from cogs.utils.metrics import Metrics
+from cogs.utils.watchdog import LoopWatchdog
+from cogs.utils.send_queue import SendQueue
+from cogs.utils.modifiers import Modifier, ModifierPipeline
+from cogs.utils.user_index import UserIndex
+from collections import Counter, OrderedDict
 from io import TextIOWrapper
 
 #         PieBot, a Discord Trading Card Game bot by PandaHappy,
@@ -40,25 +48,94 @@ from io import TextIOWrapper
 
 description = "PieBot - A discord trading card game bot!"
 VERSION = "Unreleased"
+# Seconds a user_allowed decision is reused for the same author / channel
+ALLOWED_CACHE_TTL = 30
+
+
+class StartupProfiler:
+    """Times the steps of the boot, reported with --profile-startup"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = []
+        self.finished = False
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.perf_counter() - start))
+
+    def mark(self, name):
+        """Records the time elapsed since the profiler was created"""
+        self.timings.append((name, time.perf_counter() - self.started))
+
+    def report(self):
+        width = max([len(n) for n, _ in self.timings] + [10])
+        lines = ["{:<{}} {:>10.2f}ms".format(name, width, seconds * 1000)
+                 for name, seconds in self.timings]
+        return "Startup profile\n" + "\n".join(lines)
+
+
+class ParsedMessage:
+    """A message parsed once by the router and passed to its handlers
+
+    invoked is the first word after the prefix, lowercased, and text the
+    whole remainder, lowercased. allowed is only computed if something
+    asks for it."""
+
+    __slots__ = ("bot", "message", "prefix", "invoked", "text", "_allowed")
+
+    def __init__(self, bot, message):
+        self.bot = bot
+        self.message = message
+        self.prefix = bot.settings.match_prefix(message.server,
+                                                message.content)
+        self.invoked = None
+        self.text = None
+        self._allowed = None
+        if self.prefix is not None:
+            self.text = message.content[len(self.prefix):].lower()
+            self.invoked = self.text.split(" ", 1)[0]
+
+    @property
+    def allowed(self):
+        if self._allowed is None:
+            self._allowed = self.bot.user_allowed(self.message)
+        return self._allowed
 
 class Bot(commands.Bot):
     def __init__(self, *args, **kwargs):
 
         def prefix_manager(bot, message):
             """
-            Returns prefixes of the message's server if set.
-            If none are set or if the message's server is None
-            it will return the global prefixes instead.
+            Returns the prefix the message starts with, matched against
+            the prefixes of the message's server if set, or the global
+            prefixes otherwise. The list is empty if none matched.
 
             Requires a Bot instance and a Message object to be
             passed as arguments.
             """
-            return bot.settings.get_prefixes(message.server)
+            prefix = bot.settings.match_prefix(message.server,
+                                               message.content)
+            return [prefix] if prefix is not None else []
 
         self.counter = Counter()
+        self.metrics = Metrics(self.counter, dataIO)
         self.uptime = datetime.datetime.utcnow()  # Refreshed before login
-        self._message_modifiers = []
-        self.settings = Settings()
+        self._message_modifiers = ModifierPipeline(self.metrics)
+        self._message_routes = {}
+        # Ordered by expiry, since every entry lives ALLOWED_CACHE_TTL
+        self._allowed_cache = OrderedDict()
+        self._lazy_commands = {}
+        self._lazy_cogs = {}
+        self._command_index = None
+        self.startup_profiler = StartupProfiler()
+        with self.startup_profiler.phase("settings"):
+            self.settings = Settings()
+        self.settings.change_hooks.append(self._settings_changed)
         self._intro_displayed = False
         self._shutdown_mode = None
         self.logger = set_logger(self)
@@ -71,32 +148,40 @@ class Bot(commands.Bot):
         except Exception:
             self._cog_registry = {}
 
+        try:
+            self._cog_commands = dataIO.load_json(
+                "data/bot/cog_commands.json")
+        except Exception:
+            self._cog_commands = {}
+
         super().__init__(*args, command_prefix=prefix_manager, **kwargs)
+        self.send_queue = SendQueue(self._send_now, self.metrics)
+        self.user_index = UserIndex()
+        for event in ("on_member_join", "on_member_remove",
+                      "on_member_update", "on_server_join",
+                      "on_server_remove"):
+            self.add_listener(getattr(self.user_index, event), event)
         
         # Unable to find a better way to fully override
         # the default help cmd, so had to do this instead. :C
         self.remove_command('help')
         self.command(**self.help_attrs)(_help_command)
 
-    async def send_message(self, *args, **kwargs):
-        if self._message_modifiers:
-            if "content" in kwargs:
-                pass
-            elif len(args) == 2:
-                args = list(args)
-                kwargs["content"] = args.pop()
-            else:
-                return await super().send_message(*args, **kwargs)
+    async def send_message(self, destination, content=None, *, merge=False,
+                           **kwargs):
+        """Queues a message, see SendQueue
 
-            content = kwargs['content']
-            for m in self._message_modifiers:
-                try:
-                    content = str(m(content))
-                except:   # Faulty modifiers should not
-                    pass  # break send_message
-            kwargs['content'] = content
+        If merge is True the message can be sent together with the
+        mergeable messages queued right before or after it."""
+        if self._message_modifiers and content is not None:
+            content = self._message_modifiers.apply(content)
+
+        return await self.send_queue.send(destination, content, kwargs,
+                                          merge=merge)
 
-        return await super().send_message(*args, **kwargs)
+    async def _send_now(self, destination, content=None, **kwargs):
+        with self.metrics.time("send_message_seconds"):
+            return await super().send_message(destination, content, **kwargs)
 
     async def shutdown(self, *, restart=False):
         """Gracefully quits Red with exit code 0
@@ -104,9 +189,10 @@ class Bot(commands.Bot):
         If restart is True, the exit code will be 26 instead
         The launcher automatically restarts Red when that happens"""
         self._shutdown_mode = not restart
+        await dataIO.flush_async(self.loop)
         await self.logout()
 
-    def add_message_modifier(self, func):
+    def add_message_modifier(self, func, *, pure=False):
         """
         Adds a message modifier to the bot
 
@@ -115,48 +201,180 @@ class Bot(commands.Bot):
         Before a message gets sent, func will get called with
         the message's content as the only argument. The message's
         content will then be modified to be the func's return
-        value.
+        value, converted with str() unless pure is True, in which case
+        func must return a str.
         Exceptions thrown by the callable will be catched and
-        silenced.
+        silenced. A modifier that keeps failing, or that is too slow,
+        gets disabled.
+
+        Returns the Modifier, which holds its statistics.
         """
         if not callable(func):
             raise TypeError("The message modifier function "
                             "must be a callable.")
 
-        self._message_modifiers.append(func)
+        modifier = Modifier(func, pure=pure)
+        self._message_modifiers.add(modifier)
+        return modifier
+
+    def add_regex_modifier(self, pattern, repl):
+        """
+        Adds a message modifier replacing pattern with repl, like
+        re.sub does
+
+        Consecutive regex modifiers are applied together in a single
+        pass, so they don't see each other's replacements.
+
+        Returns the Modifier, which can be passed to
+        remove_message_modifier.
+        """
+        modifier = Modifier(pattern=pattern, repl=repl)
+        self._message_modifiers.add(modifier)
+        return modifier
 
     def remove_message_modifier(self, func):
-        """Removes a message modifier from the bot"""
-        if func not in self._message_modifiers:
+        """Removes a message modifier from the bot
+
+        func is either the callable or the Modifier returned when it
+        was added"""
+        modifier = self._message_modifiers.find(func)
+        if modifier is None:
             raise RuntimeError("Function not present in the message "
                                "modifiers.")
 
-        self._message_modifiers.remove(func)
+        self._message_modifiers.remove(modifier)
 
     def clear_message_modifiers(self):
         """Removes all message modifiers from the bot"""
         self._message_modifiers.clear()
 
+    def add_command_route(self, server_id, name, handler):
+        """
+        Routes the messages of a server invoking name to handler
+
+        Meant for cogs that react to their own prefixed words, such as
+        aliases. Messages match if name is their first word or their
+        whole text after the prefix, so names can have spaces. handler
+        is a coroutine function accepting the message and its
+        ParsedMessage. It is only called for allowed users.
+        """
+        self._add_route((server_id, name.lower()), handler)
+
+    def remove_command_route(self, server_id, name, handler):
+        """Removes a route added with add_command_route"""
+        self._remove_route((server_id, name.lower()), handler)
+
+    def add_channel_route(self, channel_id, handler):
+        """
+        Routes every message sent in a channel to handler
+
+        handler is called like for add_command_route, whether the
+        author is allowed or not.
+        """
+        self._add_route(channel_id, handler)
+
+    def remove_channel_route(self, channel_id, handler):
+        """Removes a route added with add_channel_route"""
+        self._remove_route(channel_id, handler)
+
+    def route_message(self, message):
+        """
+        Parses the message and schedules the handlers routed to it
+
+        Returns the ParsedMessage
+        """
+        parsed = ParsedMessage(self, message)
+        handlers = list(self._message_routes.get(message.channel.id, ()))
+        if parsed.invoked and message.server is not None:
+            for name in (parsed.invoked, parsed.text):
+                key = (message.server.id, name)
+                if key in self._message_routes and parsed.allowed:
+                    handlers.extend(h for h in self._message_routes[key]
+                                    if h not in handlers)
+        for handler in handlers:
+            self.loop.create_task(self._run_route(handler, message, parsed))
+        return parsed
+
+    async def _run_route(self, handler, message, parsed):
+        owner = getattr(handler, "__self__", None)
+        name = type(owner).__name__ if owner else handler.__qualname__
+        try:
+            with self.metrics.time("message_handler_seconds", handler=name):
+                await handler(message, parsed)
+        except Exception as e:
+            self.logger.exception("Exception in message handler {}"
+                                  "".format(handler.__qualname__),
+                                  exc_info=e)
+
+    def _add_route(self, key, handler):
+        self._message_routes.setdefault(key, []).append(handler)
+
+    def _remove_route(self, key, handler):
+        handlers = self._message_routes.get(key, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if not handlers:
+            self._message_routes.pop(key, None)
+
     async def send_cmd_help(self, ctx):
         if ctx.invoked_subcommand:
-            embed = embeds.CmdUsageEmbed(ctx, ctx.invoked_subcommand)
+            embed = embeds.CmdUsageEmbed.cached(ctx, ctx.invoked_subcommand)
             await self.send_message(ctx.message.channel, embed=embed)
         elif ctx.command:
-            embed = embeds.CmdUsageEmbed(ctx, ctx.command)
+            embed = embeds.CmdUsageEmbed.cached(ctx, ctx.command)
             await self.send_message(ctx.message.channel, embed=embed)
 
+    def _settings_changed(self, what, server_id):
+        if what == "prefixes":
+            embeds.help_cache.clear()  # Help shows the prefixes
+        elif what == "roles":
+            checks.privileges.invalidate(server_id)
+
     def user_allowed(self, message):
         author = message.author
 
         if author.bot:
             return False
 
-        mod_cog = self.get_cog('Mod')
-        global_ignores = self.get_cog('Owner').global_ignores
-
         if self.settings.owner == author.id:
             return True
 
+        key = (author.id, message.channel.id)
+        now = time.monotonic()
+        cached = self._allowed_cache.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        # Expired entries are at the front, key among them if it expired
+        while self._allowed_cache:
+            oldest = next(iter(self._allowed_cache.values()))
+            if oldest[0] > now:
+                break
+            self._allowed_cache.popitem(last=False)
+        allowed = self._check_user_allowed(message)
+        self._allowed_cache[key] = (now + ALLOWED_CACHE_TTL, allowed)
+        return allowed
+
+    def invalidate_user_allowed(self, user_id=None):
+        """
+        Drops the cached user_allowed decisions of a user, or all of
+        them if user_id is None
+
+        Must be called whenever something the decision depends on
+        changes, such as the blacklist or the admin / mod roles.
+        """
+        if user_id is None:
+            self._allowed_cache.clear()
+        else:
+            for key in [k for k in self._allowed_cache if k[0] == user_id]:
+                del self._allowed_cache[key]
+
+    def _check_user_allowed(self, message):
+        author = message.author
+
+        mod_cog = self.get_cog('Mod')
+        global_ignores = self.get_cog('Owner').global_ignores
+
         if author.id in global_ignores["blacklist"]:
             return False
 
@@ -229,9 +447,144 @@ class Bot(commands.Bot):
     def save_cogs(self):
         dataIO.save_json("data/bot/cogs.json", self._cog_registry)
 
+    def add_command(self, command):
+        super().add_command(command)
+        self._command_index = None
+
+    def remove_command(self, name):
+        command = super().remove_command(name)
+        self._command_index = None
+        return command
+
+    def get_command(self, name, *, ignore_case=False):
+        """Returns the command or subcommand with that qualified name,
+        aliases included, or None
+
+        Example: get_command("bank balance")"""
+        if self._command_index is None:
+            self._command_index = self._build_command_index()
+        name = " ".join(name.split())
+        if ignore_case:
+            return self._command_index[1].get(name.lower())
+        return self._command_index[0].get(name)
+
+    def _build_command_index(self):
+        index = {}
+
+        def walk(prefix, commands):
+            for name, command in commands.items():
+                index[prefix + name] = command
+                if getattr(command, "commands", None):
+                    walk(prefix + name + " ", command.commands)
+
+        walk("", self.commands)
+        lower = {}
+        for name, command in index.items():
+            lower.setdefault(name.lower(), command)
+        return index, lower
+
+    def load_extension(self, name):
+        """Loads an extension, timing its import and setup
+
+        The commands it adds are remembered, so that the extension can
+        be deferred with add_lazy_extension at the next boot. Only
+        extensions setting LAZY = True at module level are deferred."""
+        self._remove_lazy_extension(name)
+        if name in self.extensions:
+            return
+        commands_before = set(self.commands)
+        cogs_before = set(self.cogs)
+        with self.startup_profiler.phase(name + " import"):
+            importlib.import_module(name)
+        with self.startup_profiler.phase(name + " setup"):
+            super().load_extension(name)
+        # Subcommands don't go through add_command
+        self._command_index = None
+        embeds.help_cache.clear()
+        entry = {
+            "commands": sorted(set(self.commands) - commands_before),
+            "cogs": sorted(set(self.cogs) - cogs_before),
+            "on_demand": getattr(sys.modules.get(name), "LAZY", False) is True
+        }
+        if self._cog_commands.get(name) != entry:
+            self._cog_commands[name] = entry
+            dataIO.save_json("data/bot/cog_commands.json",
+                             self._cog_commands)
+
+    def unload_extension(self, name):
+        self._remove_lazy_extension(name)
+        super().unload_extension(name)
+        self._command_index = None
+        embeds.help_cache.clear()
+
+    def can_load_lazily(self, name):
+        """Returns True if the extension's commands are known and it
+        asked to be loaded on demand"""
+        entry = self._cog_commands.get(name)
+        return bool(entry and entry.get("on_demand") and entry["commands"])
+
+    def add_lazy_extension(self, name):
+        """Defers loading an extension until one of its commands is
+        invoked. See can_load_lazily"""
+        entry = self._cog_commands[name]
+        for command in entry["commands"]:
+            self._lazy_commands[command] = name
+        for cog in entry.get("cogs", ()):
+            self._lazy_cogs[cog] = name
+
+    @property
+    def deferred_cogs(self):
+        """The names of the cogs whose extension hasn't been loaded yet"""
+        return sorted(self._lazy_cogs)
+
+    async def load_lazy_command(self, invoked):
+        """Loads the deferred extension providing invoked, if any
+
+        Returns True if an extension was loaded"""
+        return await self._load_deferred(self._lazy_commands.get(invoked))
+
+    async def load_lazy_cog(self, cog):
+        """Loads the deferred extension providing the cog, if any
+
+        Returns True if an extension was loaded"""
+        return await self._load_deferred(self._lazy_cogs.get(cog))
+
+    async def _load_deferred(self, name):
+        if name is None:
+            return False
+        try:
+            self.load_extension(name)
+        except Exception as e:
+            self._remove_lazy_extension(name)
+            self.logger.exception("Failed to load {} on demand"
+                                  "".format(name), exc_info=e)
+            return False
+        await self.get_cog('Owner').disable_commands()
+        return True
+
+    def has_command(self, name):
+        """Returns True if name is a command, deferred ones included"""
+        return name in self.commands or name in self._lazy_commands
+
+    async def process_commands(self, message):
+        """Loads the deferred extension of the invoked command first"""
+        prefix = self.settings.match_prefix(message.server, message.content)
+        if prefix is not None and self._lazy_commands:
+            invoked = message.content[len(prefix):].split(" ", 1)[0]
+            if invoked in self._lazy_commands:
+                await self.load_lazy_command(invoked)
+        await super().process_commands(message)
+
+    def _remove_lazy_extension(self, name):
+        for command in [c for c, n in self._lazy_commands.items()
+                        if n == name]:
+            del self._lazy_commands[command]
+        for cog in [c for c, n in self._lazy_cogs.items() if n == name]:
+            del self._lazy_cogs[cog]
+
     @property
     def first_run(self):
-        return self.settings.bot_settings == self.settings.default_settings
+        return self.settings.first_run
 
 class Formatter(commands.HelpFormatter):
     def __init__(self, *args, **kwargs):
@@ -259,6 +612,15 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
     __main__.settings = bot.settings            # sucks
     __main__.set_cog = bot.set_cog              # greatly
 
+    dataIO.write_behind_interval = bot.settings.save_interval
+    bot.loop.create_task(dataIO.write_behind(bot.loop))
+
+    bot.watchdog = LoopWatchdog(bot, bot.settings.lag_threshold)
+    bot.watchdog.start()
+    if bot.settings.metrics_port:
+        bot.loop.create_task(bot.metrics.serve("127.0.0.1",
+                                               bot.settings.metrics_port))
+
     async def get_oauth_url():
         try:
             data = await bot.application_info()
@@ -268,8 +630,7 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
 
     async def set_bot_owner():
         if bot.settings.owner:
-            owner = discord.utils.get(bot.get_all_members(),
-                                      id=bot.settings.owner)
+            owner = bot.user_index.get(bot.settings.owner)
             if not owner:
                 try:
                     owner = await bot.get_user_info(bot.settings.owner)
@@ -294,6 +655,7 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
 
     @bot.event
     async def on_ready():
+        bot.user_index.rebuild(bot.get_all_members())
         if bot._intro_displayed:
             return
         bot._intro_displayed = True
@@ -339,30 +701,88 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
 
         await bot.get_cog('Owner').disable_commands()
 
+        profiler = bot.startup_profiler
+        if bot.settings.profile_startup and not profiler.finished:
+            profiler.finished = True
+            profiler.mark("first on_ready (since start)")
+            print(profiler.report())
+
     @bot.event
     async def on_resumed():
         bot.counter["session_resumed"] += 1
 
+    @bot.event
+    async def on_member_update(before, after):
+        if before.roles != after.roles:
+            bot.invalidate_user_allowed(after.id)
+            checks.privileges.invalidate(after.server.id, after.id)
+
+    @bot.event
+    async def on_member_remove(member):
+        checks.privileges.invalidate(member.server.id, member.id)
+
+    @bot.event
+    async def on_server_update(before, after):
+        checks.privileges.invalidate(after.id)
+
+    @bot.event
+    async def on_server_remove(server):
+        checks.privileges.invalidate(server.id)
+
+    @bot.event
+    async def on_channel_update(before, after):
+        if not after.is_private:
+            checks.privileges.invalidate(after.server.id)
+
+    @bot.event
+    async def on_server_role_update(before, after):
+        if before.name != after.name:
+            bot.invalidate_user_allowed()
+        checks.privileges.invalidate(after.server.id)
+
+    @bot.event
+    async def on_server_role_delete(role):
+        bot.invalidate_user_allowed()
+        checks.privileges.invalidate(role.server.id)
+
     @bot.event
     async def on_command(command, ctx):
         bot.counter["processed_commands"] += 1
+        ctx.metrics_started = time.perf_counter()
+
+    @bot.event
+    async def on_command_completion(command, ctx):
+        observe_command(ctx, "completed")
+
+    def observe_command(ctx, outcome):
+        started = getattr(ctx, "metrics_started", None)
+        if started is not None and ctx.command is not None:
+            bot.metrics.observe("command_seconds",
+                                time.perf_counter() - started,
+                                command=ctx.command.qualified_name,
+                                outcome=outcome)
 
     @bot.event
     async def on_message(message):
         bot.counter["messages_read"] += 1
 
-        if bot.user_allowed(message):
+        with bot.metrics.time("message_handler_seconds", handler="core"):
+            parsed = bot.route_message(message)
+            allowed = parsed.prefix is not None and parsed.allowed
+        if allowed:
             await bot.process_commands(message)
 
     @bot.event
     async def on_command_error(error, ctx):
+        observe_command(ctx, "failed")
         channel = ctx.message.channel
         if isinstance(error, commands.MissingRequiredArgument):
             await bot.send_cmd_help(ctx)
         elif isinstance(error, commands.BadArgument):
             await bot.send_cmd_help(ctx)
         elif isinstance(error, commands.DisabledCommand):
-            await bot.send_message(channel, "That command is disabled.")
+            await bot.send_message(channel, "That command is disabled.",
+                                   merge=True)
         elif isinstance(error, commands.CommandInvokeError):
             # A bit hacky, couldn't find a better way
             no_dms = "Cannot send messages to this user"
@@ -395,7 +815,8 @@ def initialize(bot_class=Bot, formatter_class=Formatter):
         elif isinstance(error, commands.CommandOnCooldown):
             await bot.send_message(channel, "This command is on cooldown. "
                                             "Try again in {:.2f}s"
-                                            "".format(error.retry_after))
+                                            "".format(error.retry_after),
+                                   merge=True)
         else:
             bot.logger.exception(type(error).__name__, exc_info=error)
 
@@ -418,9 +839,13 @@ def _help_command(ctx, *commands : str):
     def repl(obj):
         return _mentions_transforms.get(obj.group(0), '')
 
+    if commands:  # A deferred cog or command is loaded to show its help
+        name = _mention_pattern.sub(repl, commands[0])
+        if not (yield from bot.load_lazy_cog(name)):
+            yield from bot.load_lazy_command(name)
 
     if len(commands) == 0:
-        embed = embeds.HelpEmbed(ctx)
+        embed = embeds.HelpEmbed.cached(ctx)
             
     elif len(commands) == 1:
         # try to see if it is a cog name
@@ -428,35 +853,37 @@ def _help_command(ctx, *commands : str):
         command = None
         if name in bot.cogs:
             command = bot.cogs[name]
-            embed = embeds.CogHelpEmbed(ctx, command)
+            embed = embeds.CogHelpEmbed.cached(ctx, command)
         elif commands[0] == 'bot':
-            embed = embeds.BotHelpEmbed(ctx)
+            embed = embeds.BotHelpEmbed.cached(ctx)
         else:
-            command = bot.commands.get(name)
+            command = bot.get_command(name)
             if command is None:
                 yield from bot.send_message(destination, bot.command_not_found.format(name))
                 return
-            embed = embeds.CmdHelpEmbed(ctx, command)
+            embed = embeds.CmdHelpEmbed.cached(ctx, command)
 
     else:
-        name = _mention_pattern.sub(repl, commands[0])
-        command = bot.commands.get(name)
+        keys = [_mention_pattern.sub(repl, key) for key in commands]
+        command = bot.get_command(" ".join(keys))
         if command is None:
-            yield from bot.send_message(destination, bot.command_not_found.format(name))
-            return
+            # Walked only to tell which part of the name is wrong
+            command = bot.commands.get(keys[0])
+            if command is None:
+                yield from bot.send_message(destination, bot.command_not_found.format(keys[0]))
+                return
 
-        for key in commands[1:]:
-            try:
-                key = _mention_pattern.sub(repl, key)
-                command = command.commands.get(key)
-                if command is None:
-                    yield from bot.send_message(destination, bot.command_not_found.format(key))
+            for key in keys[1:]:
+                try:
+                    command = command.commands.get(key)
+                    if command is None:
+                        yield from bot.send_message(destination, bot.command_not_found.format(key))
+                        return
+                except AttributeError:
+                    yield from bot.send_message(destination, bot.command_has_no_subcommands.format(command, key))
                     return
-            except AttributeError:
-                yield from bot.send_message(destination, bot.command_has_no_subcommands.format(command, key))
-                return
 
-        embed = embeds.CmdHelpEmbed(ctx, command)
+        embed = embeds.CmdHelpEmbed.cached(ctx, command)
 
     if bot.pm_help is None:
         if len(embed) > 1000:
@@ -476,7 +903,7 @@ def check_folders():
 
 
 def interactive_setup(settings):
-    first_run = settings.bot_settings == settings.default_settings
+    first_run = settings.first_run
 
     if first_run:
         print("First run configuration\n")
@@ -617,6 +1044,20 @@ def load_cogs(bot):
             print("Please follow the instructions carefully and reinstall the bot again.")
             exit(1)
 
+    core = ("cogs.general", "cogs.tcg", "cogs.owner")
+    for name, enabled in sorted(bot._cog_registry.items()):
+        if not enabled or name in core:
+            continue
+        if bot.can_load_lazily(name):
+            bot.add_lazy_extension(name)
+            continue
+        try:
+            bot.load_extension(name)
+        except Exception as e:
+            print("Failed to load {}: {}".format(name, e))
+            bot.logger.exception("Failed to load {}".format(name),
+                                 exc_info=e)
+
     bot.save_cogs()
 
 
@@ -624,10 +1065,15 @@ def load_cogs(bot):
 def main(bot):
     check_folders()
     if not bot.settings.no_prompt:
-        interactive_setup(bot.settings)
-    load_cogs(bot)
+        with bot.startup_profiler.phase("interactive setup"):
+            with bot.settings.batch():
+                interactive_setup(bot.settings)
+    with bot.startup_profiler.phase("load cogs (total)"):
+        load_cogs(bot)
 
     if bot.settings._dry_run:
+        if bot.settings.profile_startup:
+            print(bot.startup_profiler.report())
         print("Quitting: dry run")
         bot._shutdown_mode = True
         exit(0)
@@ -636,7 +1082,8 @@ def main(bot):
     bot.uptime = datetime.datetime.utcnow()
 
     if bot.settings.login_credentials:
-        yield from bot.login(*bot.settings.login_credentials)
+        with bot.startup_profiler.phase("login"):
+            yield from bot.login(*bot.settings.login_credentials)
     else:
         print("No credentials available to login.")
         raise RuntimeError()